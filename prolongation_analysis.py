@@ -1,8 +1,50 @@
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import seaborn as sns
 import warnings
 import re
+import os
+import sys
+import io
+import time
+import argparse
+import contextlib
+import tempfile
+import hashlib
+import json
+import heapq
+import pickle
+import glob
+import csv
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    from prometheus_client import CollectorRegistry, Counter, Gauge, start_http_server, write_to_textfile
+except ImportError:  # метрики необязательны
+    CollectorRegistry = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:  # без pyarrow используется pd.read_csv
+    pa_csv = None
+
+try:
+    import jinja2
+    from markupsafe import Markup, escape
+except ImportError:  # без Jinja2 HTML-отчет не создается
+    jinja2 = None
+
+try:
+    import ipywidgets as widgets
+    from IPython.display import display
+except ImportError:  # интерактивный просмотр только в ноутбуке
+    widgets = None
 
 warnings.filterwarnings('ignore')
 
@@ -13,30 +55,59 @@ plt.style.use('seaborn-v0_8')
 sns.set_palette("husl")
 
 
-def prepare_financial_data(financial_df):
-    """Подготовка финансовых данных"""
-    financial_df = financial_df.copy()
-    month_columns = [col for col in financial_df.columns if
-                     col not in ['id', 'Причина дубля', 'Account', 'Unnamed: 0']]
-
-    def convert_to_float(value):
-        if pd.isna(value) or value is None:
-            return 0.0
-        if isinstance(value, (int, float)):
-            return float(value)
-        if isinstance(value, str):
-            if value.lower() in ['стоп', 'stop', 'nan', '', 'в ноль', 'end']:
-                return 0.0
-            value_clean = re.sub(r'[^\d,.]', '', value.replace(' ', ''))
-            value_clean = value_clean.replace(',', '.')
-            try:
-                return float(value_clean)
-            except ValueError:
-                return 0.0
+def convert_to_float(value):
+    """Преобразование значения отгрузки в число ("стоп", "в ноль" и т.п. -> 0)"""
+    if pd.isna(value) or value is None:
         return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        if value.lower() in ['стоп', 'stop', 'nan', '', 'в ноль', 'end']:
+            return 0.0
+        value_clean = re.sub(r'[^\d,.]', '', value.replace(' ', ''))
+        value_clean = value_clean.replace(',', '.')
+        try:
+            return float(value_clean)
+        except ValueError:
+            return 0.0
+    return 0.0
+
+
+MONTH_MAPPING = {
+    'январь': '01', 'февраль': '02', 'март': '03', 'апрель': '04',
+    'май': '05', 'июнь': '06', 'июль': '07', 'август': '08',
+    'сентябрь': '09', 'октябрь': '10', 'ноябрь': '11', 'декабрь': '12'
+}
+
+FINANCIAL_ID_COLUMNS = ['id', 'Причина дубля', 'Account', 'Unnamed: 0']
+
+
+def convert_russian_month(month_str):
+    """Преобразование 'Январь 2023' в '2023-01'"""
+    try:
+        parts = month_str.split()
+        if len(parts) == 2:
+            month_ru = parts[0].lower()
+            year = parts[1]
+            if month_ru in MONTH_MAPPING:
+                month_num = MONTH_MAPPING[month_ru]
+                return f"{year}-{month_num}"
+    except Exception:
+        pass
+    return month_str
+
+
+def melt_financial_data(financial_df):
+    """Длинный формат финансовых данных: строка выгрузки × месяц, до выбора одной строки на (id, month)"""
+    financial_df = financial_df.copy()
+    month_columns = [col for col in financial_df.columns if col not in FINANCIAL_ID_COLUMNS]
 
     for col in month_columns:
-        financial_df[col] = financial_df[col].apply(convert_to_float)
+        if pd.api.types.is_numeric_dtype(financial_df[col]):
+            # Уже типизированная колонка (read_financial_csv) - без поэлементного разбора
+            financial_df[col] = financial_df[col].astype(float).fillna(0.0)
+        else:
+            financial_df[col] = financial_df[col].apply(convert_to_float)
 
     financial_long = pd.melt(
         financial_df,
@@ -46,32 +117,246 @@ def prepare_financial_data(financial_df):
         value_name='shipment_amount'
     )
 
-    def convert_russian_month(month_str):
-        month_mapping = {
-            'январь': '01', 'февраль': '02', 'март': '03', 'апрель': '04',
-            'май': '05', 'июнь': '06', 'июль': '07', 'август': '08',
-            'сентябрь': '09', 'октябрь': '10', 'ноябрь': '11', 'декабрь': '12'
-        }
-        try:
-            parts = month_str.split()
-            if len(parts) == 2:
-                month_ru = parts[0].lower()
-                year = parts[1]
-                if month_ru in month_mapping:
-                    month_num = month_mapping[month_ru]
-                    return f"{year}-{month_num}"
-        except Exception:
-            pass
-        return month_str
-
-    financial_long['month'] = financial_long['month'].apply(convert_russian_month)
-    financial_long = financial_long[financial_long['shipment_amount'] >= 0]
+    financial_long['month'] = financial_long['month'].map({col: convert_russian_month(col) for col in month_columns})
+    return financial_long[financial_long['shipment_amount'] >= 0]
+
+
+def deduplicate_financial_rows(financial_long):
+    """Одна строка на (id, month): из дублей проекта берется наибольшая сумма"""
     financial_long = financial_long.sort_values('shipment_amount', ascending=False)
-    financial_long = financial_long.drop_duplicates(['id', 'month'], keep='first')
+    return financial_long.drop_duplicates(['id', 'month'], keep='first')
+
+
+def prepare_financial_data(financial_df):
+    """Подготовка финансовых данных"""
+    return deduplicate_financial_rows(melt_financial_data(financial_df))
+
+
+# Маркеры без суммы, которые читатель сразу превращает в null (-> 0.0)
+SHIPMENT_NULL_TOKENS = ['', 'стоп', 'Стоп', 'СТОП', 'stop', 'Stop', 'STOP', 'nan', 'NaN',
+                        'в ноль', 'В ноль', 'В НОЛЬ', 'end', 'End', 'END']
+
+
+def _parse_russian_numbers(column):
+    """
+    Разбор сумм вида '36 220,00' средствами Arrow compute
+    Как в convert_to_float: убираются все символы кроме цифр, запятой и точки,
+    запятая заменяется на точку, неразборчивые значения и маркеры дают 0.0
+    """
+    cleaned = pc.replace_substring_regex(column, pattern=r'[^\d,.]', replacement='')
+    cleaned = pc.replace_substring(cleaned, pattern=',', replacement='.')
+    is_number = pc.match_substring_regex(cleaned, pattern=r'^(\d+\.?\d*|\.\d+)$')
+    numbers = pc.cast(pc.if_else(is_number, cleaned, pa.scalar(None, pa.string())), pa.float64())
+    return pc.fill_null(numbers, 0.0)
+
+
+def _read_csv_header(path):
+    """Имена колонок CSV как в файле (pandas переименовывает повторы в 'Январь 2023.1')"""
+    with open(path, encoding='utf-8-sig', newline='') as csv_file:
+        return next(csv.reader(csv_file), [])
+
+
+def read_financial_csv(path, use_threads=True, with_raw=False):
+    """
+    Типизированное чтение financial_data.csv многопоточным CSV-читателем Arrow
+    Месячные колонки возвращаются как float64: десятичная запятая, пробелы-разделители
+    разрядов и маркеры "стоп"/"в ноль"/"end" разбираются при чтении.
+    Без pyarrow или при повторяющихся заголовках - обычный pd.read_csv (разбор выполнит prepare_financial_data)
+    with_raw=True дополнительно возвращает исходные строковые значения для validate_input_data
+    """
+    header = _read_csv_header(path)
+    duplicated_header = len(set(header)) != len(header)
+    if duplicated_header:
+        # Arrow не читает файл с повторяющимися именами колонок; pandas переименует повтор,
+        # и validate_input_data сообщит о нем как о нераспознанном заголовке
+        print(f"⚠️  Повторяющиеся заголовки в {path}, чтение без Arrow")
+    if pa_csv is None or duplicated_header:
+        financial_df = pd.read_csv(path)
+        return (financial_df, financial_df) if with_raw else financial_df
+
+    header = pd.read_csv(path, nrows=0).columns
+    month_columns = [col for col in header if col not in FINANCIAL_ID_COLUMNS]
+    table = pa_csv.read_csv(
+        path,
+        read_options=pa_csv.ReadOptions(use_threads=use_threads),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={col: pa.string() for col in month_columns + ['Причина дубля', 'Account']},
+            null_values=SHIPMENT_NULL_TOKENS,
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=True,
+        )
+    )
+
+    raw_table = table
+    for col in month_columns:
+        position = table.schema.get_field_index(col)
+        table = table.set_column(position, col, _parse_russian_numbers(table.column(col)))
+
+    financial_df = table.to_pandas()
+    # Имена безымянных колонок как у pandas ('Unnamed: 0')
+    financial_df.columns = [col if col else f'Unnamed: {i}' for i, col in enumerate(financial_df.columns)]
+    if with_raw:
+        financial_raw = raw_table.to_pandas()
+        financial_raw.columns = financial_df.columns
+        return financial_df, financial_raw
+    return financial_df
+
+
+def _load_and_prepare_financial_file(path):
+    """Чтение и подготовка одного файла выгрузки (выполняется в пуле)"""
+    financial_df = read_financial_csv(path)
+    financial_long = prepare_financial_data(financial_df)
+    financial_long['source'] = os.path.splitext(os.path.basename(path))[0]
+    return financial_long
+
+
+def resolve_financial_sources(source):
+    """Список файлов выгрузок по пути к файлу, каталогу или glob-шаблону"""
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, '*.csv'))
+    elif glob.has_magic(source):
+        paths = glob.glob(source)
+    else:
+        paths = [source]
+    return sorted(paths)
+
+
+def load_financial_exports(source, max_workers=None, use_processes=True):
+    """
+    Параллельная загрузка региональных выгрузок financial_data.csv
+    source - каталог, glob-шаблон или путь к одному файлу
+    Каждый файл разбирается prepare_financial_data в отдельном воркере,
+    результаты объединяются в один набор с колонкой source
+    """
+    paths = resolve_financial_sources(source)
+    if not paths:
+        raise FileNotFoundError(f"Не найдено файлов финансовых данных: {source}")
+
+    print(f"\n📥 Загрузка выгрузок: {len(paths)} файл(ов)")
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    workers = min(len(paths), max_workers or os.cpu_count() or 1)
+    with executor_class(max_workers=workers) as executor:
+        # map сохраняет порядок файлов, поэтому результат детерминирован
+        prepared_frames = list(executor.map(_load_and_prepare_financial_file, paths))
+
+    # Выравнивание месяцев: у выгрузок разный набор месячных колонок,
+    # после подготовки они приведены к YYYY-MM и объединяются по ключу month
+    frame_months = [set(frame['month']) for frame in prepared_frames]
+    all_months = sorted(set().union(*frame_months))
+    for path, frame, months in zip(paths, prepared_frames, frame_months):
+        missing_months = [month for month in all_months if month not in months]
+        print(f"   {os.path.basename(path)}: {len(frame)} записей, "
+              f"{frame['id'].nunique()} проектов"
+              + (f", нет месяцев: {', '.join(missing_months)}" if missing_months else ""))
+
+    financial_long = pd.concat(prepared_frames, ignore_index=True)
+    print(f"   Итого: {len(financial_long)} записей, {len(all_months)} месяцев")
 
     return financial_long
 
 
+# Пробелы-разделители разрядов, включая неразрывные (типичны для выгрузок из 1С/Excel)
+AMOUNT_SPACES = '\\s\u00a0\u202f'
+
+
+def _raw_amount_checks(column):
+    """
+    Векторная проверка исходной месячной колонки
+    Возвращает маски (неразборчивые значения, отрицательные суммы)
+    """
+    if pd.api.types.is_numeric_dtype(column):
+        return pd.Series(False, index=column.index), column.fillna(0) < 0
+
+    values = column.astype('string')
+    # Один проход регулярным выражением: корректные суммы вида '36 220,00' отсеиваются сразу,
+    # подробно разбираются только оставшиеся (обычно единичные) значения
+    well_formed = values.str.fullmatch(f'[\\d{AMOUNT_SPACES}]+([,.]\\d*)?|[,.]\\d+').fillna(True).astype(bool)
+    suspicious = values[~well_formed]
+
+    is_sentinel = suspicious.str.strip().str.lower().isin(['стоп', 'stop', 'nan', '', 'в ноль', 'end'])
+    is_negative = suspicious.str.fullmatch(f'[{AMOUNT_SPACES}]*-[\\d{AMOUNT_SPACES}]+([,.]\\d*)?').fillna(False)
+
+    unparseable = pd.Series(False, index=column.index)
+    negative = pd.Series(False, index=column.index)
+    unparseable[suspicious.index] = (~is_sentinel & ~is_negative).astype(bool)
+    negative[suspicious.index] = is_negative.astype(bool)
+    return unparseable, negative
+
+
+def validate_input_data(financial_raw, prolongations_data):
+    """
+    Проверка качества исходных данных (векторными операциями, без поэлементного Python)
+    financial_raw - financial_data.csv с исходными строковыми значениями
+    Возвращает {'summary': сводка по проверкам, 'issues': по строке на каждую проблему}
+    """
+    print("\n" + "=" * 60)
+    print("🔎 ПРОВЕРКА КАЧЕСТВА ДАННЫХ")
+    print("=" * 60)
+
+    month_columns = [col for col in financial_raw.columns if col not in FINANCIAL_ID_COLUMNS]
+    issue_frames = []
+
+    def add_issues(check, ids, column=None, values=None):
+        if len(ids) == 0:
+            return
+        issue_frames.append(pd.DataFrame({
+            'check': check,
+            'id': list(ids),
+            'column': column,
+            'value': values if values is not None else None
+        }))
+
+    # 1-2. Неразборчивые значения и отрицательные суммы по колонкам
+    for col in month_columns:
+        unparseable, negative = _raw_amount_checks(financial_raw[col])
+        add_issues('Неразборчивое значение', financial_raw.loc[unparseable, 'id'], col,
+                   financial_raw.loc[unparseable, col].astype(str).tolist())
+        add_issues('Отрицательная сумма', financial_raw.loc[negative, 'id'], col,
+                   financial_raw.loc[negative, col].astype(str).tolist())
+
+    # 3. Заголовки, не распознанные как месяц
+    unknown_headers = [col for col in month_columns if not re.fullmatch(r'\d{4}-\d{2}', convert_russian_month(col))]
+    add_issues('Неизвестный заголовок месяца', [None] * len(unknown_headers), unknown_headers)
+
+    prolongation_months = pd.Series(prolongations_data['month'].dropna().unique())
+    unknown_prolongation_months = prolongation_months[
+        ~prolongation_months.map(convert_russian_month).str.fullmatch(r'\d{4}-\d{2}').fillna(False)]
+    add_issues('Неизвестный месяц в prolongations.csv', [None] * len(unknown_prolongation_months), 'month',
+               unknown_prolongation_months.tolist())
+
+    # 4. Расхождение состава проектов
+    financial_ids = financial_raw['id'].dropna().unique()
+    prolongation_ids = prolongations_data['id'].dropna().unique()
+    add_issues('Нет в financial_data.csv', np.setdiff1d(prolongation_ids, financial_ids))
+    add_issues('Нет в prolongations.csv', np.setdiff1d(financial_ids, prolongation_ids))
+
+    # 5. Аномалии дублей
+    reason = financial_raw['Причина дубля']
+    rows_per_id = financial_raw.groupby('id')['id'].transform('size')
+    duplicate_without_reason = (rows_per_id > 1) & reason.isna()
+    reason_without_duplicate = (rows_per_id == 1) & reason.notna()
+    repeated_reason = reason.notna() & financial_raw.duplicated(['id', 'Причина дубля'], keep=False)
+    add_issues('Дубль без причины', financial_raw.loc[duplicate_without_reason, 'id'].unique(), 'Причина дубля')
+    add_issues('Причина дубля без дубля', financial_raw.loc[reason_without_duplicate, 'id'], 'Причина дубля',
+               reason[reason_without_duplicate].tolist())
+    add_issues('Повтор причины дубля', financial_raw.loc[repeated_reason, 'id'].unique(), 'Причина дубля')
+
+    issues = pd.concat(issue_frames, ignore_index=True) if issue_frames else \
+        pd.DataFrame(columns=['check', 'id', 'column', 'value'])
+
+    checks = ['Неразборчивое значение', 'Отрицательная сумма', 'Неизвестный заголовок месяца',
+              'Неизвестный месяц в prolongations.csv', 'Нет в financial_data.csv', 'Нет в prolongations.csv',
+              'Дубль без причины', 'Причина дубля без дубля', 'Повтор причины дубля']
+    summary = issues.groupby('check').size().reindex(checks, fill_value=0).rename('issues').reset_index()
+
+    for _, row in summary.iterrows():
+        status = '⚠️ ' if row['issues'] > 0 else '✅'
+        print(f"   {status} {row['check']}: {row['issues']}")
+
+    return {'summary': summary, 'issues': issues}
+
+
 def get_previous_month(month):
     """Получение предыдущего месяца в формате YYYY-MM"""
     try:
@@ -334,244 +619,2974 @@ def calculate_manager_prolongation_metrics(financial_long_data, prolongations_da
     return pd.DataFrame(manager_results_list)
 
 
-def create_visualizations(first_coeff_results, second_coeff_results):
-    """Создание визуализаций"""
-    print("\n" + "=" * 60)
-    print("📊 ВИЗУАЛИЗАЦИЯ РЕЗУЛЬТАТОВ")
-    print("=" * 60)
+# ============================================================
+# OUT-OF-CORE РЕЖИМ: дисковая матрица отгрузок проект×месяц
+# ============================================================
 
-    if len(first_coeff_results) > 0:
-        fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(16, 12))
+def build_shipment_memmap(financial_csv_path, storage_dir, chunksize=100000):
+    """
+    Построение дисковой (memory-mapped) матрицы отгрузок проект×месяц
+    Файл читается частями, в памяти одновременно находится только один chunk.
+    Матрица хранится по столбцам (fortran order): месяц - непрерывный блок на диске.
+    Возвращает (shipment_matrix, project_ids, months)
+    """
+    os.makedirs(storage_dir, exist_ok=True)
 
-        # График 1: Динамика первого коэффициента пролонгации
-        ax1.plot(first_coeff_results['month'], first_coeff_results['prolongation_rate'],
-                 marker='o', linewidth=2, markersize=6, color='blue')
-        ax1.set_title('Динамика первого коэффициента пролонгации', fontsize=14, fontweight='bold')
-        ax1.set_xlabel('Месяц')
-        ax1.set_ylabel('Коэффициент пролонгации')
-        ax1.tick_params(axis='x', rotation=45)
-        ax1.grid(True, alpha=0.3)
-        ax1.set_ylim(0, 1)
+    header = pd.read_csv(financial_csv_path, nrows=0).columns
+    month_columns = [col for col in header if col not in FINANCIAL_ID_COLUMNS]
+    column_months = [convert_russian_month(col) for col in month_columns]
+    months = sorted(set(column_months))
+    month_index = {month: i for i, month in enumerate(months)}
 
-        # Добавляем значения на график
-        for i, row in first_coeff_results.iterrows():
-            ax1.annotate(f'{row["prolongation_rate"]:.1%}',
-                         (row['month'], row['prolongation_rate']),
-                         textcoords="offset points", xytext=(0, 10), ha='center', fontsize=8)
+    # Проход 1: индекс проектов
+    id_chunks = [chunk['id'].unique() for chunk in
+                 pd.read_csv(financial_csv_path, usecols=['id'], chunksize=chunksize)]
+    project_ids = np.unique(np.concatenate(id_chunks)) if id_chunks else np.array([], dtype=np.int64)
+    if project_ids.dtype == object:
+        project_ids = project_ids.astype(str)
 
-        # График 2: Количество пролонгированных проектов
-        ax2.bar(first_coeff_results['month'], first_coeff_results['prolongated_projects'],
-                alpha=0.7, color='green')
-        ax2.set_title('Количество пролонгированных проектов (1-й коэффициент)', fontsize=14, fontweight='bold')
-        ax2.set_xlabel('Месяц')
-        ax2.set_ylabel('Количество проектов')
-        ax2.tick_params(axis='x', rotation=45)
-        ax2.grid(True, alpha=0.3)
+    shipment_matrix = np.lib.format.open_memmap(
+        os.path.join(storage_dir, 'shipments.npy'), mode='w+', dtype=np.float64,
+        shape=(len(project_ids), len(months)), fortran_order=True
+    )
+    np.save(os.path.join(storage_dir, 'project_ids.npy'), project_ids)
+    np.save(os.path.join(storage_dir, 'months.npy'), np.array(months))
 
-        # Добавляем значения на столбцы
-        for i, v in enumerate(first_coeff_results['prolongated_projects']):
-            ax2.text(i, v + 0.5, str(v), ha='center', va='bottom', fontsize=9)
+    # Проход 2: заполнение матрицы.
+    # Как и в prepare_financial_data: отрицательные суммы отбрасываются,
+    # из дублей (id, month) берется максимальная сумма
+    for chunk in pd.read_csv(financial_csv_path, usecols=['id'] + month_columns, chunksize=chunksize):
+        chunk_ids = chunk['id'].to_numpy()
+        if project_ids.dtype.kind == 'U':
+            chunk_ids = chunk_ids.astype(str)
+        rows = np.searchsorted(project_ids, chunk_ids)
+        for col, month in zip(month_columns, column_months):
+            values = chunk[col].map(convert_to_float).to_numpy(dtype=np.float64)
+            np.maximum.at(shipment_matrix[:, month_index[month]], rows, values)
+        shipment_matrix.flush()
 
-        # График 3: Второй коэффициент пролонгации
-        if second_coeff_results:
-            second_coeff_df = pd.DataFrame(second_coeff_results)
-            ax3.bar(second_coeff_df['month'], second_coeff_df['coefficient_second'] / 100,
-                    alpha=0.7, color='orange')
-            ax3.set_title('Второй коэффициент пролонгации', fontsize=14, fontweight='bold')
-            ax3.set_xlabel('Месяц')
-            ax3.set_ylabel('Коэффициент пролонгации')
-            ax3.tick_params(axis='x', rotation=45)
-            ax3.grid(True, alpha=0.3)
-            ax3.set_ylim(0, 1)
+    print(f"💽 Матрица отгрузок {shipment_matrix.shape[0]}×{shipment_matrix.shape[1]} "
+          f"сохранена в {storage_dir}")
 
-            # Добавляем значения на столбцы
-            for i, row in second_coeff_df.iterrows():
-                ax3.text(i, row['coefficient_second'] / 100 + 0.02,
-                         f'{row["coefficient_second"]:.1f}%',
-                         ha='center', va='bottom', fontsize=9)
+    return load_shipment_memmap(storage_dir)
 
-        # График 4: Сравнение объемов отгрузок
-        ax4.bar(first_coeff_results['month'], first_coeff_results['total_prev_shipment'] / 1000000,
-                alpha=0.6, label='Общие отгрузки', color='blue')
-        ax4.bar(first_coeff_results['month'], first_coeff_results['prolongated_shipment'] / 1000000,
-                alpha=0.8, label='Пролонгированные', color='red')
-        ax4.set_title('Объемы отгрузок (млн руб.)', fontsize=14, fontweight='bold')
-        ax4.set_xlabel('Месяц')
-        ax4.set_ylabel('Сумма отгрузок, млн руб.')
-        ax4.tick_params(axis='x', rotation=45)
-        ax4.legend()
-        ax4.grid(True, alpha=0.3)
 
-        plt.tight_layout()
-        plt.savefig('improved_prolongation_analysis.png', dpi=300, bbox_inches='tight')
-        plt.show()
+def load_shipment_memmap(storage_dir):
+    """Открытие ранее построенной матрицы отгрузок только для чтения"""
+    shipment_matrix = np.load(os.path.join(storage_dir, 'shipments.npy'), mmap_mode='r')
+    project_ids = np.load(os.path.join(storage_dir, 'project_ids.npy'))
+    months = [str(month) for month in np.load(os.path.join(storage_dir, 'months.npy'))]
+    return shipment_matrix, project_ids, months
 
-        print("✅ Графики сохранены в improved_prolongation_analysis.png")
+
+def build_shipment_matrix(financial_long_data):
+    """
+    Матрица отгрузок проект×месяц в памяти из подготовленных данных
+    Суммы по (id, month) складываются, как в get_shipment_amount
+    Возвращает (shipment_matrix, project_ids, months)
+    """
+    pivot = financial_long_data.pivot_table(index='id', columns='month', values='shipment_amount',
+                                            aggfunc='sum', fill_value=0.0).sort_index().sort_index(axis=1)
+    return np.asfortranarray(pivot.to_numpy(dtype=np.float64)), pivot.index.to_numpy(), list(pivot.columns)
+
+
+def _read_month_column(shipment_matrix, months, month):
+    """Столбец месяца из матрицы (нули, если месяца нет в данных)"""
+    if month in months:
+        return np.asarray(shipment_matrix[:, months.index(month)])
+    return np.zeros(shipment_matrix.shape[0])
 
 
-def create_comprehensive_report(first_coeff_results, second_coeff_results, manager_results, financial_long_data):
+def calculate_first_prolongation_coefficient_blocked(shipment_matrix, months, block_size=12):
     """
-    Создание комплексного отчета
+    Первый коэффициент пролонгации по матрице отгрузок
+    Матрица обрабатывается блоками по block_size месяцев (с перекрытием в один месяц),
+    поэтому потребление памяти не зависит от длины истории
     """
-    print("\n" + "=" * 60)
-    print("💾 СОЗДАНИЕ КОМПЛЕКСНОГО ОТЧЕТА")
-    print("=" * 60)
+    results_list = []
+    for block_start in range(1, len(months), block_size):
+        block_end = min(block_start + block_size, len(months))
+        # Блок включает предыдущий месяц для первого месяца блока
+        block = np.asarray(shipment_matrix[:, block_start - 1:block_end])
 
-    with pd.ExcelWriter('comprehensive_prolongation_report.xlsx', engine='openpyxl') as writer:
+        for offset in range(1, block.shape[1]):
+            prev_amounts = block[:, offset - 1]
+            current_amounts = block[:, offset]
+            had_prev_shipment = prev_amounts > 0
+            continued = had_prev_shipment & (current_amounts > 0)
 
-        # 1. Сводка по отделу
-        summary_data = {
-            'Показатель': [
-                'Средний коэффициент пролонгации (1-й)',
-                'Средний коэффициент пролонгации (2-й)',
-                'Всего пролонгировано проектов',
-                'Общий объем пролонгированных отгрузок',
-                'Период анализа',
-                'Количество менеджеров'
-            ],
-            'Значение': [
-                f"{first_coeff_results['prolongation_rate'].mean() * 100:.2f}%" if len(
-                    first_coeff_results) > 0 else "0.00%",
-                f"{pd.DataFrame(second_coeff_results)['coefficient_second'].mean():.2f}%" if second_coeff_results else "0.00%",
-                f"{first_coeff_results['prolongated_projects'].sum()}" if len(first_coeff_results) > 0 else "0",
-                f"{first_coeff_results['prolongated_shipment'].sum():,.0f} руб." if len(
-                    first_coeff_results) > 0 else "0 руб.",
-                f"{first_coeff_results['month'].min()} - {first_coeff_results['month'].max()}" if len(
-                    first_coeff_results) > 0 else "Нет данных",
-                f"{manager_results['manager'].nunique()}" if len(manager_results) > 0 else "0"
-            ]
-        }
-        pd.DataFrame(summary_data).to_excel(writer, sheet_name='Сводка по отделу', index=False)
+            total_prev_shipment = prev_amounts[had_prev_shipment].sum()
+            continued_shipment = current_amounts[continued].sum()
+            prolongation_rate = continued_shipment / total_prev_shipment if total_prev_shipment > 0 else 0
 
-        # 2. Детальные результаты по месяцам (1-й коэффициент)
-        if len(first_coeff_results) > 0:
-            results_with_percent = first_coeff_results.copy()
-            results_with_percent['prolongation_rate_percent'] = results_with_percent['prolongation_rate'] * 100
-            results_with_percent[['month', 'previous_month', 'projects_with_prev_shipment',
-                                  'prolongated_projects', 'total_prev_shipment', 'prolongated_shipment',
-                                  'prolongation_rate_percent']].to_excel(writer, sheet_name='1-й коэффициент',
-                                                                         index=False)
+            month_position = block_start - 1 + offset
+            results_list.append({
+                'month': months[month_position],
+                'previous_month': months[month_position - 1],
+                'projects_with_prev_shipment': int(had_prev_shipment.sum()),
+                'prolongated_projects': int(continued.sum()),
+                'total_prev_shipment': total_prev_shipment,
+                'prolongated_shipment': continued_shipment,
+                'prolongation_rate': prolongation_rate
+            })
 
-        # 3. Второй коэффициент пролонгации
-        if second_coeff_results:
-            second_coeff_df = pd.DataFrame(second_coeff_results)
-            second_coeff_df.to_excel(writer, sheet_name='2-й коэффициент', index=False)
+    return pd.DataFrame(results_list)
 
-        # 4. Результаты по менеджерам
-        if len(manager_results) > 0:
-            manager_summary = manager_results.groupby('manager').agg({
-                'prolongation_rate': 'mean',
-                'projects_with_prev_shipment': 'sum',
-                'prolongated_projects': 'sum',
-                'total_prev_shipment': 'sum',
-                'prolongated_shipment': 'sum'
-            }).reset_index()
-            manager_summary['prolongation_rate'] = manager_summary['prolongation_rate'].round(2)
-            manager_summary.to_excel(writer, sheet_name='Итоги по менеджерам', index=False)
 
-            # Детальные данные по менеджерам
-            manager_details = manager_results.copy()
-            manager_details['prolongation_rate'] = manager_details['prolongation_rate'].round(2)
-            manager_details.to_excel(writer, sheet_name='Детали по менеджерам', index=False)
+def calculate_second_prolongation_coefficient_blocked(analysis_months, shipment_matrix, project_ids, months):
+    """
+    Второй коэффициент пролонгации по матрице отгрузок
+    Для каждого месяца читаются только три нужных столбца
+    """
+    results_list = []
+    for month in analysis_months:
+        completion_month = get_previous_month(get_previous_month(month))
+        first_prolongation_month = get_previous_month(month)
 
-        # 5. Топ менеджеров
-        if len(manager_results) > 0:
-            top_managers = manager_results.groupby('manager')['prolongation_rate'].mean().nlargest(5)
-            pd.DataFrame({
-                'Менеджер': top_managers.index,
-                'Средний коэффициент': top_managers.values.round(2)
-            }).to_excel(writer, sheet_name='Топ менеджеров', index=False)
+        completion_amounts = _read_month_column(shipment_matrix, months, completion_month)
+        first_amounts = _read_month_column(shipment_matrix, months, first_prolongation_month)
+        second_amounts = _read_month_column(shipment_matrix, months, month)
 
-        # 6. Исходные данные
-        financial_long_data.head(1000).to_excel(writer, sheet_name='Исходные данные', index=False)
+        skipped = (completion_amounts > 0) & (first_amounts == 0)
+        returned = skipped & (second_amounts > 0)
 
-    print("✅ Комплексный отчет сохранен в comprehensive_prolongation_report.xlsx")
+        total_completion_amount = completion_amounts[skipped].sum()
+        total_second_prolongation_amount = second_amounts[returned].sum()
+        if total_completion_amount > 0:
+            coefficient = (total_second_prolongation_amount / total_completion_amount) * 100
+        else:
+            coefficient = 0
 
+        results_list.append({
+            'month': month,
+            'completion_month': completion_month,
+            'first_prolongation_month': first_prolongation_month,
+            'projects_count': int(skipped.sum()),
+            'prolonged_count_second': int(returned.sum()),
+            'total_completion_amount': total_completion_amount,
+            'total_second_prolongation_amount': total_second_prolongation_amount,
+            'coefficient_second': coefficient,
+            'prolonged_projects': project_ids[returned].tolist()
+        })
 
-def calculate_complete_prolongation_analysis():
-    """Полный анализ пролонгации с исправленной логикой"""
-    print("🚀 ЗАПУСК ИСПРАВЛЕННОГО АНАЛИЗА ПРОЛОНГАЦИЙ")
-    print("=" * 60)
+    return results_list
 
-    # Загрузка данных
-    prolongations_data = pd.read_csv('prolongations.csv')
-    financial_data = pd.read_csv('financial_data.csv')
 
-    # Подготовка данных
-    financial_long_prepared = prepare_financial_data(financial_data)
+def build_manager_project_index(project_ids, prolongations_data):
+    """
+    Индексы строк матрицы для каждого менеджера
+    Проект с несколькими менеджерами учитывается у каждого, проекты без менеджера - 'без А/М'
+    (пустой AM, как в calculate_manager_prolongation_metrics, тоже считается 'без А/М')
+    """
+    project_managers = prolongations_data[['id', 'AM']].copy()
+    project_managers['AM'] = project_managers['AM'].fillna('без А/М')
+    project_managers = project_managers.drop_duplicates()
+    project_managers = project_managers[project_managers['id'].isin(project_ids)]
+    rows = np.searchsorted(project_ids, project_managers['id'].to_numpy())
 
-    # Расчет первого коэффициента пролонгации
-    first_coeff_results = calculate_first_prolongation_coefficient(financial_long_prepared)
+    manager_rows = {manager: np.sort(rows[(project_managers['AM'] == manager).to_numpy()])
+                    for manager in project_managers['AM'].unique()}
 
-    # Расчет второго коэффициента пролонгации (ИСПРАВЛЕННЫЙ)
-    print("\n" + "=" * 60)
-    print("🔄 РАСЧЕТ ВТОРОГО КОЭФФИЦИЕНТА ПРОЛОНГАЦИИ (ИСПРАВЛЕННЫЙ)")
-    print("=" * 60)
+    without_manager = np.ones(len(project_ids), dtype=bool)
+    without_manager[rows] = False
+    if without_manager.any():
+        # 'без А/М' может встречаться и явно в prolongations.csv - объединяем с проектами без назначений
+        manager_rows['без А/М'] = np.union1d(manager_rows.get('без А/М', np.array([], dtype=np.intp)),
+                                             np.flatnonzero(without_manager))
 
-    second_coeff_results_list = []
-    analysis_months_2023 = [month for month in sorted(financial_long_prepared['month'].unique())
-                            if month.startswith('2023')]
+    return manager_rows
 
-    for month in analysis_months_2023[:6]:  # Анализируем первые 6 месяцев 2023
-        try:
-            second_coeff_data = calculate_second_prolongation_coefficient_corrected(month, financial_long_prepared)
-            second_coeff_results_list.append(second_coeff_data)
-        except Exception as e:
-            print(f"❌ Ошибка при расчете второго коэффициента для {month}: {e}")
 
-    # Расчет по менеджерам
-    manager_results_df = calculate_manager_prolongation_metrics(financial_long_prepared, prolongations_data)
+def _manager_row_map(manager_rows):
+    """Пары (row, manager) по индексу build_manager_project_index - для merge с таблицами по строкам матрицы"""
+    return pd.DataFrame({
+        'row': np.concatenate(list(manager_rows.values())) if manager_rows else np.array([], dtype=int),
+        'manager': np.repeat(list(manager_rows), [len(manager_project_rows)
+                                                  for manager_project_rows in manager_rows.values()]),
+    })
 
-    # Визуализация результатов
-    create_visualizations(first_coeff_results, second_coeff_results_list)
 
-    # Создание комплексного отчета
-    create_comprehensive_report(first_coeff_results, second_coeff_results_list, manager_results_df,
-                                financial_long_prepared)
+def _group_membership(manager_rows, n_projects):
+    """
+    Принадлежность проектов группам: (groups, матрица группа×проект из 0/1)
+    Первая группа - весь отдел (каждый проект один раз), далее менеджеры по алфавиту
+    """
+    groups = [DEPARTMENT_LABEL] + sorted(manager_rows)
+    membership = np.zeros((len(groups), n_projects))
+    membership[0, :] = 1
+    for i, manager in enumerate(groups[1:], 1):
+        membership[i, manager_rows[manager]] = 1
+    return groups, membership
 
-    # Сводная статистика
-    print("\n" + "=" * 60)
-    print("📈 СВОДНАЯ СТАТИСТИКА")
-    print("=" * 60)
 
-    if len(first_coeff_results) > 0:
-        avg_prolongation_rate = first_coeff_results['prolongation_rate'].mean()
-        total_prolongated_projects = first_coeff_results['prolongated_projects'].sum()
-        total_prolongated_shipment = first_coeff_results['prolongated_shipment'].sum()
+def _typical_shipment_amount(shipment_matrix, recent_months=3):
+    """Средняя ненулевая сумма отгрузки проекта за recent_months последних месяцев (0 - отгрузок не было)"""
+    recent = shipment_matrix[:, -recent_months:]
+    recent_counts = (recent > 0).sum(axis=1)
+    return np.divide(recent.sum(axis=1), recent_counts, out=np.zeros(len(shipment_matrix)),
+                     where=recent_counts > 0)
 
-        print(f"📊 ОБЩИЕ РЕЗУЛЬТАТЫ:")
-        print(f"   • Средний коэффициент пролонгации (1-й): {avg_prolongation_rate:.2%}")
-        print(f"   • Всего пролонгировано проектов: {total_prolongated_projects}")
-        print(f"   • Общий объем пролонгированных отгрузок: {total_prolongated_shipment:,.0f} руб.")
-        print(
-            f"   • Анализированный период: {first_coeff_results['month'].min()} - {first_coeff_results['month'].max()}")
 
-        if second_coeff_results_list:
-            second_avg = pd.DataFrame(second_coeff_results_list)['coefficient_second'].mean()
-            print(f"   • Средний коэффициент пролонгации (2-й): {second_avg:.2f}%")
+def calculate_manager_prolongation_metrics_blocked(shipment_matrix, project_ids, months, prolongations_data,
+                                                   analysis_months=None, managers=None, manager_rows=None):
+    """
+    Коэффициенты пролонгации по менеджерам по матрице отгрузок
+    managers - ограничить расчет этими менеджерами
+    manager_rows - готовый результат build_manager_project_index
+    """
+    if analysis_months is None:
+        analysis_months = [month for month in months if month.startswith('2023')][:6]
 
-        # Лучшие месяцы по пролонгации
-        best_months = first_coeff_results.nlargest(3, 'prolongation_rate')
-        print(f"\n🏆 ЛУЧШИЕ МЕСЯЦЫ ПО ПРОЛОНГАЦИИ:")
-        for _, row in best_months.iterrows():
-            print(f"   • {row['month']}: {row['prolongation_rate']:.2%} ({row['prolongated_projects']} проектов)")
+    if manager_rows is None:
+        manager_rows = build_manager_project_index(project_ids, prolongations_data)
+    if managers is not None:
+        manager_rows = {manager: rows for manager, rows in manager_rows.items() if manager in managers}
 
-    return first_coeff_results, second_coeff_results_list, manager_results_df
+    manager_results_list = []
+    for month in analysis_months:
+        prev_month = get_previous_month(month)
+        prev_amounts = _read_month_column(shipment_matrix, months, prev_month)
+        current_amounts = _read_month_column(shipment_matrix, months, month)
 
+        for manager, rows in manager_rows.items():
+            manager_prev = prev_amounts[rows]
+            had_prev_shipment = manager_prev > 0
+            if not had_prev_shipment.any():
+                continue
 
-# ЗАПУСК ПРОГРАММЫ
-if __name__ == "__main__":
-    first_coeff, second_coeff, manager_results = calculate_complete_prolongation_analysis()
+            manager_current = current_amounts[rows]
+            continued = had_prev_shipment & (manager_current > 0)
+            total_prev_shipment = manager_prev[had_prev_shipment].sum()
+            continued_shipment = manager_current[continued].sum()
+            prolongation_rate = (continued_shipment / total_prev_shipment) * 100 if total_prev_shipment > 0 else 0
 
-    print("\n🎉 ПОЛНЫЙ АНАЛИЗ ЗАВЕРШЕН!")
+            manager_results_list.append({
+                'month': month,
+                'manager': manager,
+                'projects_with_prev_shipment': int(had_prev_shipment.sum()),
+                'prolongated_projects': int(continued.sum()),
+                'total_prev_shipment': total_prev_shipment,
+                'prolongated_shipment': continued_shipment,
+                'prolongation_rate': prolongation_rate
+            })
+
+    return pd.DataFrame(manager_results_list)
+
+
+def calculate_out_of_core_prolongation_analysis(financial_csv_path='financial_data.csv',
+                                                prolongations_csv_path='prolongations.csv',
+                                                storage_dir='shipment_store', rebuild=True):
+    """
+    Анализ пролонгации в out-of-core режиме для истории, не помещающейся в память
+    Возвращает те же структуры, что и calculate_complete_prolongation_analysis
+    """
+    print("🚀 ЗАПУСК OUT-OF-CORE АНАЛИЗА ПРОЛОНГАЦИЙ")
     print("=" * 60)
-    print("Созданные файлы:")
-    print("  1. improved_prolongation_analysis.png - Графики анализа")
-    print("  2. comprehensive_prolongation_report.xlsx - Полный отчет")
-    print("\n📊 ОСНОВНЫЕ РЕЗУЛЬТАТЫ:")
-    print(f"  • Проанализировано месяцев: {len(first_coeff)}")
-    print(f"  • Рассчитано вторых коэффициентов: {len(second_coeff)}")
-    print(f"  • Проанализировано менеджеров: {manager_results['manager'].nunique() if len(manager_results) > 0 else 0}")
+
+    if rebuild or not os.path.exists(os.path.join(storage_dir, 'shipments.npy')):
+        shipment_matrix, project_ids, months = build_shipment_memmap(financial_csv_path, storage_dir)
+    else:
+        shipment_matrix, project_ids, months = load_shipment_memmap(storage_dir)
+        PIPELINE_METRICS.cache_hit('shipment_store')
+
+    prolongations_data = pd.read_csv(prolongations_csv_path)
+
+    # Расчетные функции по матрице не печатают заголовков - их используют и сессия, и сценарии "что если"
+    print("\n" + "=" * 60)
+    print("🧮 РАСЧЕТ ПЕРВОГО КОЭФФИЦИЕНТА ПРОЛОНГАЦИИ (OUT-OF-CORE)")
+    print("=" * 60)
+    first_coeff_results = calculate_first_prolongation_coefficient_blocked(shipment_matrix, months)
+    print(f"   Рассчитано месяцев: {len(first_coeff_results)}")
+
+    analysis_months_2023 = [month for month in months if month.startswith('2023')][:6]
+    second_coeff_results_list = calculate_second_prolongation_coefficient_blocked(
+        analysis_months_2023, shipment_matrix, project_ids, months)
+
+    print("\n" + "=" * 60)
+    print("👥 РАСЧЕТ КОЭФФИЦИЕНТОВ ПО МЕНЕДЖЕРАМ (OUT-OF-CORE)")
+    print("=" * 60)
+    manager_results_df = calculate_manager_prolongation_metrics_blocked(
+        shipment_matrix, project_ids, months, prolongations_data, analysis_months_2023)
+    managers_count = manager_results_df['manager'].nunique() if len(manager_results_df) > 0 else 0
+    print(f"   Менеджеров: {managers_count}, записей: {len(manager_results_df)}")
+
+    return first_coeff_results, second_coeff_results_list, manager_results_df
+
+
+def calculate_prolongation_drilldown(shipment_matrix, project_ids, months, manager_rows, analysis_months):
+    """
+    Вклад проектов в коэффициенты: строка на (коэффициент, месяц, проект, менеджер)
+    first - проекты с отгрузкой в предыдущем месяце (по всем месяцам истории),
+    second - проекты с отгрузкой два месяца назад и пропуском в прошлом (месяцы analysis_months).
+    base_amount - база коэффициента, prolonged_amount - отгрузка в месяце расчета (0, если не продлен).
+    Проект с несколькими менеджерами повторяется у каждого из них, поэтому итоги по отделу
+    считаются после drop_duplicates(['coefficient', 'month', 'id'])
+    """
+    shipment_matrix = np.asarray(shipment_matrix)
+
+    # Первый коэффициент: все пары соседних месяцев одной маской
+    prev_amounts = shipment_matrix[:, :-1]
+    current_amounts = shipment_matrix[:, 1:]
+    rows, columns = np.nonzero(prev_amounts > 0)
+    first = pd.DataFrame({
+        'coefficient': 'first',
+        'month': np.asarray(months[1:], dtype=object)[columns],
+        'base_month': np.asarray(months[:-1], dtype=object)[columns],
+        'row': rows,
+        'base_amount': prev_amounts[rows, columns],
+        'prolonged_amount': np.where(current_amounts > 0, current_amounts, 0.0)[rows, columns],
+    })
+
+    # Второй коэффициент: столбцы трех месяцев для всех месяцев анализа
+    completion_months = [get_previous_month(get_previous_month(month)) for month in analysis_months]
+    completion_amounts = np.column_stack([_read_month_column(shipment_matrix, months, month)
+                                          for month in completion_months] or [np.zeros(len(project_ids))])
+    first_amounts = np.column_stack([_read_month_column(shipment_matrix, months, get_previous_month(month))
+                                     for month in analysis_months] or [np.zeros(len(project_ids))])
+    second_amounts = np.column_stack([_read_month_column(shipment_matrix, months, month)
+                                      for month in analysis_months] or [np.zeros(len(project_ids))])
+    rows, columns = np.nonzero((completion_amounts > 0) & (first_amounts == 0))
+    second = pd.DataFrame({
+        'coefficient': 'second',
+        'month': np.asarray(analysis_months, dtype=object)[columns],
+        'base_month': np.asarray(completion_months, dtype=object)[columns],
+        'row': rows,
+        'base_amount': completion_amounts[rows, columns],
+        'prolonged_amount': np.where(second_amounts > 0, second_amounts, 0.0)[rows, columns],
+    })
+
+    drilldown = pd.concat([first, second], ignore_index=True).merge(_manager_row_map(manager_rows), on='row',
+                                                                    how='left')
+    drilldown['manager'] = drilldown['manager'].fillna('без А/М')
+    drilldown['id'] = project_ids[drilldown['row'].to_numpy()]
+    drilldown['prolonged'] = drilldown['prolonged_amount'] > 0
+    for column in ('coefficient', 'month', 'base_month', 'manager'):
+        drilldown[column] = drilldown[column].astype('category')
+
+    return drilldown[['coefficient', 'month', 'base_month', 'id', 'manager', 'base_amount',
+                      'prolonged_amount', 'prolonged']]
+
+
+def export_prolongation_drilldown(drilldown, output_path='prolongation_drilldown.parquet'):
+    """Запись детализации в сжатый Parquet (zstd) для BI-инструментов"""
+    if pa_csv is None:
+        raise RuntimeError("Для записи детализации в Parquet требуется pyarrow")
+
+    with atomic_output(output_path) as temp_path:
+        drilldown.to_parquet(temp_path, engine='pyarrow', compression='zstd', index=False)
+    print(f"✅ Детализация по проектам ({len(drilldown)} строк) сохранена в {output_path}")
+    return output_path
+
+
+# ============================================================
+# СЕССИЯ АНАЛИЗА: подготовленные индексы для повторных расчетов
+# ============================================================
+
+class ProlongationSession:
+    """
+    Сессия анализа для ноутбуков и пакетных расчетов
+    Данные готовятся один раз: матрица отгрузок проект×месяц, индексы месяцев и проектов
+    и строки матрицы по менеджерам. Методы повторяют существующие расчеты, но не
+    фильтруют financial_long_data заново при каждом вызове
+    financial_rows - строки melt_financial_data до выбора одной строки на (id, month);
+    нужны сценариям what_if с отбором строк (по причине дубля и сумме), чтобы исключение записи
+    возвращало другую строку-дубль проекта. Без них такие сценарии недоступны (ValueError)
+    """
+
+    def __init__(self, financial_long_data, prolongations_data, financial_rows=None):
+        self.financial_long_data = financial_long_data
+        self.prolongations_data = prolongations_data
+        self.shipment_matrix, self.project_ids, self.months = build_shipment_matrix(financial_long_data)
+        self.month_index = {month: position for position, month in enumerate(self.months)}
+        self.project_index = pd.Index(self.project_ids)
+        self.manager_rows = build_manager_project_index(self.project_ids, prolongations_data)
+        self.has_financial_rows = financial_rows is not None
+        if self.has_financial_rows:
+            self._build_row_arrays(financial_rows)
+
+    def _build_row_arrays(self, financial_rows):
+        """Массивы строк выгрузки: ячейка матрицы, сумма, код 'Причина дубля' (-1 - не указана), источник"""
+        rows = self.project_index.get_indexer(financial_rows['id'])
+        columns = financial_rows['month'].map(self.month_index).fillna(-1).to_numpy(dtype=np.intp)
+        known = (rows >= 0) & (columns >= 0)
+        self.row_cells = (rows[known], columns[known])
+        self.row_amounts = financial_rows['shipment_amount'].to_numpy(dtype=np.float64)[known]
+
+        if 'Причина дубля' in financial_rows.columns:
+            reasons = pd.Categorical(financial_rows['Причина дубля'])
+            self.reasons, self.row_reasons = list(reasons.categories), reasons.codes[known]
+        else:
+            self.reasons, self.row_reasons = [], np.full(known.sum(), -1, dtype=np.int8)
+        # Выгрузки разных источников складываются, строка-дубль выбирается внутри источника
+        if 'source' in financial_rows.columns:
+            self.row_sources = pd.factorize(financial_rows['source'])[0][known]
+        else:
+            self.row_sources = np.zeros(known.sum(), dtype=np.intp)
+
+    @classmethod
+    def from_csv(cls, financial_csv_path='financial_data.csv', prolongations_csv_path='prolongations.csv'):
+        """Сессия по исходным CSV"""
+        financial_rows = melt_financial_data(read_financial_csv(financial_csv_path))
+        return cls(deduplicate_financial_rows(financial_rows), pd.read_csv(prolongations_csv_path), financial_rows)
+
+    @property
+    def managers(self):
+        return sorted(self.manager_rows)
+
+    def default_analysis_months(self):
+        """Первые 6 месяцев 2023 года, как в calculate_manager_prolongation_metrics"""
+        return [month for month in self.months if month.startswith('2023')][:6]
+
+    def month_amounts(self, month):
+        """Отгрузки всех проектов за месяц (нули, если месяца нет в данных)"""
+        if month in self.month_index:
+            return self.shipment_matrix[:, self.month_index[month]]
+        return np.zeros(len(self.project_ids))
+
+    def shipment_amount(self, project_id, month):
+        """Аналог get_shipment_amount"""
+        if project_id not in self.project_index or month not in self.month_index:
+            return 0.0
+        return float(self.shipment_matrix[self.project_index.get_loc(project_id), self.month_index[month]])
+
+    def projects_with_shipment(self, month):
+        """Аналог get_projects_with_shipment_in_month"""
+        return self.project_ids[self.month_amounts(month) > 0].tolist()
+
+    def manager_projects(self, manager):
+        """Проекты менеджера ('без А/М' - проекты без менеджера)"""
+        return self.project_ids[self.manager_rows.get(manager, [])].tolist()
+
+    def first_coefficient(self):
+        """Аналог calculate_first_prolongation_coefficient"""
+        return calculate_first_prolongation_coefficient_blocked(self.shipment_matrix, self.months)
+
+    def second_coefficient(self, month):
+        """Аналог calculate_second_prolongation_coefficient_corrected для одного месяца"""
+        return self.second_coefficients([month])[0]
+
+    def second_coefficients(self, analysis_months=None):
+        """Второй коэффициент по списку месяцев (по умолчанию первые 6 месяцев 2023)"""
+        if analysis_months is None:
+            analysis_months = self.default_analysis_months()
+        return calculate_second_prolongation_coefficient_blocked(analysis_months, self.shipment_matrix,
+                                                                 self.project_ids, self.months)
+
+    def manager_metrics(self, analysis_months=None, managers=None):
+        """Аналог calculate_manager_prolongation_metrics"""
+        return calculate_manager_prolongation_metrics_blocked(
+            self.shipment_matrix, self.project_ids, self.months, self.prolongations_data,
+            analysis_months, managers, manager_rows=self.manager_rows)
+
+    def top_projects(self, n=5):
+        """n проектов с наибольшей суммой отгрузок за всю историю"""
+        return self.project_ids[np.argsort(-self.shipment_matrix.sum(axis=1), kind='stable')[:n]].tolist()
+
+    def what_if_matrix(self, include_projects=None, exclude_projects=None, include_managers=None,
+                       exclude_managers=None, include_reasons=None, exclude_reasons=None,
+                       min_amount=None, max_amount=None):
+        """
+        Матрица отгрузок проект×месяц для сценария "что если" - как после правки CSV и повторной подготовки
+        Проекты отбираются по id и по менеджерам (проект исключается, если у него есть
+        исключенный менеджер), строки выгрузки - по 'Причина дубля' (None - причина не указана)
+        и по порогам суммы; в каждой ячейке заново берется наибольшая из оставшихся строк
+        """
+        project_mask = np.ones(len(self.project_ids), dtype=bool)
+        if include_projects is not None:
+            project_mask &= np.isin(self.project_ids, list(include_projects))
+        if exclude_projects is not None:
+            project_mask &= ~np.isin(self.project_ids, list(exclude_projects))
+        if include_managers is not None:
+            included = np.zeros(len(self.project_ids), dtype=bool)
+            for manager in include_managers:
+                included[self.manager_rows.get(manager, [])] = True
+            project_mask &= included
+        if exclude_managers is not None:
+            for manager in exclude_managers:
+                project_mask[self.manager_rows.get(manager, [])] = False
+
+        if include_reasons is None and exclude_reasons is None and min_amount is None and max_amount is None:
+            # Отбор только по проектам - выбор строк-дублей не меняется
+            return np.where(project_mask[:, None], self.shipment_matrix, 0.0)
+        if not self.has_financial_rows:
+            # По уже очищенным от дублей данным исключенная строка не может уступить место другой строке-дублю
+            raise ValueError("Отбор по 'Причина дубля' и сумме требует строк до удаления дублей: "
+                             "ProlongationSession.from_csv(...) или financial_rows=melt_financial_data(...)")
+
+        row_mask = project_mask[self.row_cells[0]]
+        reason_lookup = {reason: code for code, reason in enumerate(self.reasons)}
+        if include_reasons is not None:
+            codes = [reason_lookup.get(reason, -2) if reason is not None else -1 for reason in include_reasons]
+            row_mask &= np.isin(self.row_reasons, codes)
+        if exclude_reasons is not None:
+            codes = [reason_lookup.get(reason, -2) if reason is not None else -1 for reason in exclude_reasons]
+            row_mask &= ~np.isin(self.row_reasons, codes)
+        if min_amount is not None:
+            row_mask &= self.row_amounts >= min_amount
+        if max_amount is not None:
+            row_mask &= self.row_amounts <= max_amount
+
+        # Наибольшая строка в ячейке (как drop_duplicates в prepare_financial_data), источники складываются
+        shipment_matrix = np.zeros(self.shipment_matrix.shape)
+        for source in np.unique(self.row_sources[row_mask]):
+            source_rows = row_mask & (self.row_sources == source)
+            source_matrix = np.zeros(self.shipment_matrix.shape)
+            np.maximum.at(source_matrix, (self.row_cells[0][source_rows], self.row_cells[1][source_rows]),
+                          self.row_amounts[source_rows])
+            shipment_matrix += source_matrix
+        return shipment_matrix
+
+    def what_if(self, analysis_months=None, **filters):
+        """
+        Пересчет коэффициентов для сценария "что если" без пересборки таблиц
+        filters - аргументы what_if_matrix; результат совпадает с расчетом по исправленному CSV
+        (отбор по причинам и суммам - только для сессии со строками financial_rows)
+        Возвращает {'first', 'second', 'managers'}
+        """
+        if analysis_months is None:
+            analysis_months = self.default_analysis_months()
+        shipment_matrix = self.what_if_matrix(**filters)
+
+        manager_rows = self.manager_rows
+        if filters.get('include_managers') is not None:
+            manager_rows = {manager: rows for manager, rows in manager_rows.items()
+                            if manager in filters['include_managers']}
+        if filters.get('exclude_managers') is not None:
+            manager_rows = {manager: rows for manager, rows in manager_rows.items()
+                            if manager not in filters['exclude_managers']}
+
+        return {
+            'first': calculate_first_prolongation_coefficient_blocked(shipment_matrix, self.months),
+            'second': calculate_second_prolongation_coefficient_blocked(analysis_months, shipment_matrix,
+                                                                        self.project_ids, self.months),
+            'managers': calculate_manager_prolongation_metrics_blocked(
+                shipment_matrix, self.project_ids, self.months, self.prolongations_data,
+                analysis_months, manager_rows=manager_rows),
+        }
+
+    def projects_at_risk(self, top_n=10, min_risk=0.5):
+        """Проекты под риском прекращения отгрузок по менеджерам (score_project_risk)"""
+        scores = score_project_risk(self.shipment_matrix, self.project_ids, self.months, self.manager_rows)
+        return _select_projects_at_risk(scores, top_n, min_risk)
+
+    def leaderboard(self):
+        """Рейтинг менеджеров по суммам за всю историю (ManagerLeaderboard)"""
+        return ManagerLeaderboard.from_session(self)
+
+    def drilldown(self, analysis_months=None):
+        """Вклад проектов в первый и второй коэффициенты (calculate_prolongation_drilldown)"""
+        if analysis_months is None:
+            analysis_months = self.default_analysis_months()
+        return calculate_prolongation_drilldown(self.shipment_matrix, self.project_ids, self.months,
+                                                self.manager_rows, analysis_months)
+
+
+# ============================================================
+# ХРАНИЛИЩЕ SQLITE: история отгрузок и назначений менеджеров
+# ============================================================
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shipments (
+    id,
+    month TEXT NOT NULL,
+    source TEXT NOT NULL DEFAULT '',
+    reason TEXT,
+    account TEXT,
+    shipment_amount REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_shipments_id_month ON shipments (id, month, source);
+CREATE INDEX IF NOT EXISTS idx_shipments_month ON shipments (month);
+
+CREATE TABLE IF NOT EXISTS prolongations (
+    id,
+    month TEXT,
+    AM TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_prolongations_am_month ON prolongations (AM, month, id);
+CREATE INDEX IF NOT EXISTS idx_prolongations_id ON prolongations (id);
+
+-- Суммы проекта за месяц (по всем источникам), как в get_shipment_amount
+CREATE VIEW IF NOT EXISTS project_month_amounts AS
+SELECT id, month, SUM(shipment_amount) AS amount
+FROM shipments
+GROUP BY id, month;
+
+-- Соответствие проект-менеджер, как в calculate_manager_prolongation_metrics
+CREATE VIEW IF NOT EXISTS project_managers AS
+SELECT DISTINCT id, COALESCE(AM, 'без А/М') AS AM FROM prolongations
+UNION
+SELECT DISTINCT id, 'без А/М' FROM shipments
+WHERE id NOT IN (SELECT id FROM prolongations);
+"""
+
+
+def open_prolongation_store(db_path='prolongation_history.sqlite'):
+    """Открытие (и при необходимости создание) SQLite-хранилища"""
+    connection = sqlite3.connect(db_path)
+    connection.executescript(SQLITE_SCHEMA)
+    return connection
+
+
+def load_into_prolongation_store(connection, financial_long_data, prolongations_data):
+    """
+    Загрузка подготовленных отгрузок и назначений в хранилище
+    Повторная загрузка тех же (id, month) перезаписывает значения, новые месяцы дописываются
+    """
+    if 'source' in financial_long_data.columns:
+        sources = financial_long_data['source'].fillna('').astype(str).tolist()
+    else:
+        sources = [''] * len(financial_long_data)
+
+    shipment_rows = zip(
+        financial_long_data['id'].tolist(),
+        financial_long_data['month'].tolist(),
+        sources,
+        financial_long_data['Причина дубля'].where(financial_long_data['Причина дубля'].notna(), None).tolist(),
+        financial_long_data['Account'].where(financial_long_data['Account'].notna(), None).tolist(),
+        financial_long_data['shipment_amount'].astype(float).tolist()
+    )
+    prolongation_rows = zip(
+        prolongations_data['id'].tolist(),
+        prolongations_data['month'].map(convert_russian_month).tolist(),
+        prolongations_data['AM'].where(prolongations_data['AM'].notna(), None).tolist()
+    )
+
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO shipments (id, month, source, reason, account, shipment_amount) "
+            "VALUES (?, ?, ?, ?, ?, ?)", shipment_rows)
+        connection.executemany(
+            "INSERT OR IGNORE INTO prolongations (id, month, AM) VALUES (?, ?, ?)", prolongation_rows)
+
+    shipments_count = connection.execute("SELECT COUNT(*) FROM shipments").fetchone()[0]
+    print(f"🗄  В хранилище {shipments_count} записей отгрузок")
+
+
+def calculate_first_prolongation_coefficient_sql(connection):
+    """Первый коэффициент пролонгации одним SQL-запросом по всем месяцам"""
+    query = """
+    WITH months AS (
+        SELECT month, LAG(month) OVER (ORDER BY month) AS previous_month
+        FROM (SELECT DISTINCT month FROM shipments)
+    )
+    SELECT m.month,
+           m.previous_month,
+           COUNT(prev.id) AS projects_with_prev_shipment,
+           COUNT(cur.id) AS prolongated_projects,
+           COALESCE(SUM(prev.amount), 0) AS total_prev_shipment,
+           COALESCE(SUM(cur.amount), 0) AS prolongated_shipment
+    FROM months m
+    LEFT JOIN project_month_amounts prev
+        ON prev.month = m.previous_month AND prev.amount > 0
+    LEFT JOIN project_month_amounts cur
+        ON cur.id = prev.id AND cur.month = m.month AND cur.amount > 0
+    WHERE m.previous_month IS NOT NULL
+    GROUP BY m.month, m.previous_month
+    ORDER BY m.month
+    """
+    results = pd.read_sql_query(query, connection)
+    results['prolongation_rate'] = (results['prolongated_shipment'] / results['total_prev_shipment']) \
+        .where(results['total_prev_shipment'] > 0, 0)
+    return results
+
+
+def calculate_second_prolongation_coefficient_sql(month, connection):
+    """Второй коэффициент пролонгации для месяца через SQL"""
+    completion_month = get_previous_month(get_previous_month(month))
+    first_prolongation_month = get_previous_month(month)
+
+    query = """
+    WITH completion AS (
+        SELECT id, SUM(shipment_amount) AS amount FROM shipments
+        WHERE month = :completion GROUP BY id HAVING amount > 0
+    ),
+    first_month AS (
+        SELECT id FROM shipments
+        WHERE month = :first GROUP BY id HAVING SUM(shipment_amount) > 0
+    ),
+    second_month AS (
+        SELECT id, SUM(shipment_amount) AS amount FROM shipments
+        WHERE month = :second GROUP BY id HAVING amount > 0
+    )
+    SELECT c.id, c.amount AS completion_amount, s.amount AS second_amount
+    FROM completion c
+    LEFT JOIN second_month s ON s.id = c.id
+    WHERE c.id NOT IN (SELECT id FROM first_month)
+    """
+    rows = pd.read_sql_query(query, connection, params={
+        'completion': completion_month, 'first': first_prolongation_month, 'second': month})
+
+    returned = rows[rows['second_amount'].notna()]
+    total_completion_amount = rows['completion_amount'].sum()
+    total_second_prolongation_amount = returned['second_amount'].sum()
+    if total_completion_amount > 0:
+        coefficient = (total_second_prolongation_amount / total_completion_amount) * 100
+    else:
+        coefficient = 0
+
+    return {
+        'month': month,
+        'completion_month': completion_month,
+        'first_prolongation_month': first_prolongation_month,
+        'projects_count': len(rows),
+        'prolonged_count_second': len(returned),
+        'total_completion_amount': total_completion_amount,
+        'total_second_prolongation_amount': total_second_prolongation_amount,
+        'coefficient_second': coefficient,
+        'prolonged_projects': returned['id'].tolist()
+    }
+
+
+def calculate_manager_prolongation_metrics_sql(connection, analysis_months=None):
+    """Коэффициенты пролонгации по менеджерам через SQL"""
+    if analysis_months is None:
+        all_months = [row[0] for row in connection.execute("SELECT DISTINCT month FROM shipments ORDER BY month")]
+        analysis_months = [month for month in all_months if month.startswith('2023')][:6]
+
+    query = """
+    WITH prev AS (
+        SELECT id, SUM(shipment_amount) AS amount FROM shipments
+        WHERE month = :prev GROUP BY id HAVING amount > 0
+    ),
+    cur AS (
+        SELECT id, SUM(shipment_amount) AS amount FROM shipments
+        WHERE month = :month GROUP BY id HAVING amount > 0
+    )
+    SELECT :month AS month,
+           pm.AM AS manager,
+           COUNT(prev.id) AS projects_with_prev_shipment,
+           COUNT(cur.id) AS prolongated_projects,
+           SUM(prev.amount) AS total_prev_shipment,
+           COALESCE(SUM(cur.amount), 0) AS prolongated_shipment
+    FROM prev
+    JOIN project_managers pm ON pm.id = prev.id
+    LEFT JOIN cur ON cur.id = prev.id
+    GROUP BY pm.AM
+    ORDER BY pm.AM
+    """
+    frames = [pd.read_sql_query(query, connection, params={'prev': get_previous_month(month), 'month': month})
+              for month in analysis_months]
+    if not frames:
+        return pd.DataFrame()
+
+    results = pd.concat(frames, ignore_index=True)
+    results['prolongation_rate'] = (results['prolongated_shipment'] / results['total_prev_shipment'] * 100) \
+        .where(results['total_prev_shipment'] > 0, 0)
+    return results
+
+
+def calculate_prolongation_analysis_sql(db_path='prolongation_history.sqlite', financial_long_data=None,
+                                        prolongations_data=None):
+    """
+    Анализ пролонгации по SQLite-хранилищу
+    Если переданы подготовленные данные - они сначала дописываются в хранилище
+    """
+    print("🚀 ЗАПУСК АНАЛИЗА ПРОЛОНГАЦИЙ ПО SQLITE-ХРАНИЛИЩУ")
+    print("=" * 60)
+
+    connection = open_prolongation_store(db_path)
+    try:
+        if financial_long_data is not None and prolongations_data is not None:
+            load_into_prolongation_store(connection, financial_long_data, prolongations_data)
+
+        first_coeff_results = calculate_first_prolongation_coefficient_sql(connection)
+        all_months = [row[0] for row in connection.execute("SELECT DISTINCT month FROM shipments ORDER BY month")]
+        analysis_months_2023 = [month for month in all_months if month.startswith('2023')][:6]
+        second_coeff_results_list = [calculate_second_prolongation_coefficient_sql(month, connection)
+                                     for month in analysis_months_2023]
+        manager_results_df = calculate_manager_prolongation_metrics_sql(connection, analysis_months_2023)
+    finally:
+        connection.close()
+
+    return first_coeff_results, second_coeff_results_list, manager_results_df
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """
+    Атомарная запись файла: запись идет во временный файл в том же каталоге,
+    который переименовывается в path только после успешного завершения
+    """
+    directory, filename = os.path.split(os.path.abspath(path))
+    stem, extension = os.path.splitext(filename)
+    handle, temp_path = tempfile.mkstemp(prefix=f'.{stem}.', suffix=extension, dir=directory)
+    os.close(handle)
+    # mkstemp создает файл с правами 0600 - возвращаем обычные права с учетом umask
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp_path, 0o666 & ~umask)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def create_visualizations(first_coeff_results, second_coeff_results):
+    """Создание визуализаций"""
+    print("\n" + "=" * 60)
+    print("📊 ВИЗУАЛИЗАЦИЯ РЕЗУЛЬТАТОВ")
+    print("=" * 60)
+
+    if len(first_coeff_results) > 0:
+        fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(16, 12))
+
+        # График 1: Динамика первого коэффициента пролонгации
+        ax1.plot(first_coeff_results['month'], first_coeff_results['prolongation_rate'],
+                 marker='o', linewidth=2, markersize=6, color='blue')
+        ax1.set_title('Динамика первого коэффициента пролонгации', fontsize=14, fontweight='bold')
+        ax1.set_xlabel('Месяц')
+        ax1.set_ylabel('Коэффициент пролонгации')
+        ax1.tick_params(axis='x', rotation=45)
+        ax1.grid(True, alpha=0.3)
+        ax1.set_ylim(0, 1)
+
+        # Добавляем значения на график
+        for i, row in first_coeff_results.iterrows():
+            ax1.annotate(f'{row["prolongation_rate"]:.1%}',
+                         (row['month'], row['prolongation_rate']),
+                         textcoords="offset points", xytext=(0, 10), ha='center', fontsize=8)
+
+        # График 2: Количество пролонгированных проектов
+        ax2.bar(first_coeff_results['month'], first_coeff_results['prolongated_projects'],
+                alpha=0.7, color='green')
+        ax2.set_title('Количество пролонгированных проектов (1-й коэффициент)', fontsize=14, fontweight='bold')
+        ax2.set_xlabel('Месяц')
+        ax2.set_ylabel('Количество проектов')
+        ax2.tick_params(axis='x', rotation=45)
+        ax2.grid(True, alpha=0.3)
+
+        # Добавляем значения на столбцы
+        for i, v in enumerate(first_coeff_results['prolongated_projects']):
+            ax2.text(i, v + 0.5, str(v), ha='center', va='bottom', fontsize=9)
+
+        # График 3: Второй коэффициент пролонгации
+        if second_coeff_results:
+            second_coeff_df = pd.DataFrame(second_coeff_results)
+            ax3.bar(second_coeff_df['month'], second_coeff_df['coefficient_second'] / 100,
+                    alpha=0.7, color='orange')
+            ax3.set_title('Второй коэффициент пролонгации', fontsize=14, fontweight='bold')
+            ax3.set_xlabel('Месяц')
+            ax3.set_ylabel('Коэффициент пролонгации')
+            ax3.tick_params(axis='x', rotation=45)
+            ax3.grid(True, alpha=0.3)
+            ax3.set_ylim(0, 1)
+
+            # Добавляем значения на столбцы
+            for i, row in second_coeff_df.iterrows():
+                ax3.text(i, row['coefficient_second'] / 100 + 0.02,
+                         f'{row["coefficient_second"]:.1f}%',
+                         ha='center', va='bottom', fontsize=9)
+
+        # График 4: Сравнение объемов отгрузок
+        ax4.bar(first_coeff_results['month'], first_coeff_results['total_prev_shipment'] / 1000000,
+                alpha=0.6, label='Общие отгрузки', color='blue')
+        ax4.bar(first_coeff_results['month'], first_coeff_results['prolongated_shipment'] / 1000000,
+                alpha=0.8, label='Пролонгированные', color='red')
+        ax4.set_title('Объемы отгрузок (млн руб.)', fontsize=14, fontweight='bold')
+        ax4.set_xlabel('Месяц')
+        ax4.set_ylabel('Сумма отгрузок, млн руб.')
+        ax4.tick_params(axis='x', rotation=45)
+        ax4.legend()
+        ax4.grid(True, alpha=0.3)
+
+        plt.tight_layout()
+        with atomic_output('improved_prolongation_analysis.png') as output_path:
+            plt.savefig(output_path, dpi=300, bbox_inches='tight')
+        plt.show()
+
+        print("✅ Графики сохранены в improved_prolongation_analysis.png")
+
+
+def _manager_chart_filename(manager):
+    """Имя файла для менеджера ('без А/М' -> 'без_А_М')"""
+    return re.sub(r'[^\w\-]+', '_', manager).strip('_') + '.png'
+
+
+def _render_manager_chart(manager, manager_data, output_path, dpi):
+    """Графики одного менеджера (выполняется в отдельном процессе, без интерактивного backend)"""
+    fig = Figure(figsize=(16, 5))
+    FigureCanvasAgg(fig)
+    ax1, ax2, ax3 = fig.subplots(1, 3)
+
+    ax1.plot(manager_data['month'], manager_data['prolongation_rate'], marker='o', linewidth=2, color='blue')
+    ax1.set_title('Коэффициент пролонгации, %', fontsize=12, fontweight='bold')
+    ax1.set_ylim(0, max(110, manager_data['prolongation_rate'].max() + 10))
+
+    ax2.bar(manager_data['month'], manager_data['prolongated_projects'], alpha=0.7, color='green')
+    ax2.set_title('Пролонгированные проекты', fontsize=12, fontweight='bold')
+
+    ax3.bar(manager_data['month'], manager_data['total_prev_shipment'] / 1000000,
+            alpha=0.6, label='Общие отгрузки', color='blue')
+    ax3.bar(manager_data['month'], manager_data['prolongated_shipment'] / 1000000,
+            alpha=0.8, label='Пролонгированные', color='red')
+    ax3.set_title('Объемы отгрузок (млн руб.)', fontsize=12, fontweight='bold')
+    ax3.legend()
+
+    for ax in (ax1, ax2, ax3):
+        ax.tick_params(axis='x', rotation=45)
+        ax.grid(True, alpha=0.3)
+
+    fig.suptitle(manager, fontsize=14, fontweight='bold')
+    fig.tight_layout()
+    with atomic_output(output_path) as temp_path:
+        fig.savefig(temp_path, dpi=dpi, bbox_inches='tight')
+    return output_path
+
+
+def _render_manager_overview(manager_results, output_path, dpi, columns=4):
+    """Обзор small multiples: динамика коэффициента всех менеджеров на одной сетке"""
+    managers = sorted(manager_results['manager'].unique())
+    rows = -(-len(managers) // columns)
+    fig = Figure(figsize=(4 * columns, 3 * rows))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(rows, columns, sharex=True, sharey=True, squeeze=False).ravel()
+
+    all_months = sorted(manager_results['month'].unique())
+    for ax, manager in zip(axes, managers):
+        manager_data = manager_results[manager_results['manager'] == manager].set_index('month') \
+            .reindex(all_months)
+        ax.plot(all_months, manager_data['prolongation_rate'], marker='o', markersize=3, linewidth=1.5)
+        ax.set_title(manager, fontsize=9)
+        ax.tick_params(axis='x', rotation=90, labelsize=7)
+        ax.grid(True, alpha=0.3)
+    for ax in axes[len(managers):]:
+        ax.set_visible(False)
+
+    fig.suptitle('Коэффициент пролонгации по менеджерам, %', fontsize=14, fontweight='bold')
+    fig.tight_layout()
+    with atomic_output(output_path) as temp_path:
+        fig.savefig(temp_path, dpi=dpi, bbox_inches='tight')
+    return output_path
+
+
+def create_manager_chart_pack(manager_results, output_dir='manager_charts', max_workers=None, dpi=150):
+    """
+    Пакет графиков по менеджерам: по файлу на менеджера и общий обзор (overview.png)
+    Графики строятся параллельно в отдельных процессах
+    """
+    print("\n" + "=" * 60)
+    print("🖼  ГРАФИКИ ПО МЕНЕДЖЕРАМ")
+    print("=" * 60)
+
+    if len(manager_results) == 0:
+        print("   Нет данных по менеджерам")
+        return []
+
+    os.makedirs(output_dir, exist_ok=True)
+    manager_results = manager_results.sort_values('month')
+    tasks = [(manager, manager_data[['month', 'prolongation_rate', 'prolongated_projects',
+                                     'total_prev_shipment', 'prolongated_shipment']].reset_index(drop=True),
+              os.path.join(output_dir, _manager_chart_filename(manager)), dpi)
+             for manager, manager_data in manager_results.groupby('manager')]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        overview = executor.submit(_render_manager_overview, manager_results,
+                                   os.path.join(output_dir, 'overview.png'), dpi)
+        paths = list(executor.map(_render_manager_chart, *zip(*tasks)))
+        paths.append(overview.result())
+
+    print(f"✅ Сохранено графиков: {len(paths)} в {output_dir}/")
+    return paths
+
+
+def create_comprehensive_report(first_coeff_results, second_coeff_results, manager_results, financial_long_data,
+                                data_quality=None, manager_ci=None, shipment_forecast=None,
+                                projects_at_risk=None, manager_leaderboard=None):
+    """
+    Создание комплексного отчета
+    data_quality - результат validate_input_data (добавляется лист 'Качество данных')
+    manager_ci - результат bootstrap_manager_rate_ci (интервалы в листе 'Топ менеджеров')
+    shipment_forecast - результат simulate_prolonged_shipments (лист 'Прогноз отгрузок')
+    projects_at_risk - результат find_projects_at_risk (лист 'Проекты под риском')
+    manager_leaderboard - результат build_manager_leaderboard (лист 'Рейтинг менеджеров')
+    """
+    print("\n" + "=" * 60)
+    print("💾 СОЗДАНИЕ КОМПЛЕКСНОГО ОТЧЕТА")
+    print("=" * 60)
+
+    with atomic_output('comprehensive_prolongation_report.xlsx') as output_path, \
+            pd.ExcelWriter(output_path, engine='openpyxl') as writer:
+
+        # 1. Сводка по отделу
+        build_department_summary(first_coeff_results, second_coeff_results, manager_results) \
+            .to_excel(writer, sheet_name='Сводка по отделу', index=False)
+
+        # 2. Детальные результаты по месяцам (1-й коэффициент)
+        if len(first_coeff_results) > 0:
+            results_with_percent = first_coeff_results.copy()
+            results_with_percent['prolongation_rate_percent'] = results_with_percent['prolongation_rate'] * 100
+            columns = ['month', 'previous_month', 'projects_with_prev_shipment', 'prolongated_projects',
+                       'total_prev_shipment', 'prolongated_shipment', 'prolongation_rate_percent']
+            if 'prolongation_rate_ci_low' in results_with_percent.columns:
+                results_with_percent['ci_low_percent'] = results_with_percent['prolongation_rate_ci_low'] * 100
+                results_with_percent['ci_high_percent'] = results_with_percent['prolongation_rate_ci_high'] * 100
+                columns += ['ci_low_percent', 'ci_high_percent']
+            results_with_percent[columns].to_excel(writer, sheet_name='1-й коэффициент', index=False)
+
+        # 3. Второй коэффициент пролонгации
+        if second_coeff_results:
+            second_coeff_df = pd.DataFrame(second_coeff_results)
+            second_coeff_df.to_excel(writer, sheet_name='2-й коэффициент', index=False)
+
+        # 4. Результаты по менеджерам
+        if len(manager_results) > 0:
+            manager_summary = manager_results.groupby('manager').agg({
+                'prolongation_rate': 'mean',
+                'projects_with_prev_shipment': 'sum',
+                'prolongated_projects': 'sum',
+                'total_prev_shipment': 'sum',
+                'prolongated_shipment': 'sum'
+            }).reset_index()
+            manager_summary['prolongation_rate'] = manager_summary['prolongation_rate'].round(2)
+            manager_summary.to_excel(writer, sheet_name='Итоги по менеджерам', index=False)
+
+            # Детальные данные по менеджерам
+            manager_details = manager_results.copy()
+            manager_details['prolongation_rate'] = manager_details['prolongation_rate'].round(2)
+            manager_details.to_excel(writer, sheet_name='Детали по менеджерам', index=False)
+
+        # 5. Топ менеджеров
+        if len(manager_results) > 0:
+            top_managers = manager_results.groupby('manager')['prolongation_rate'].mean().nlargest(5)
+            top_managers_df = pd.DataFrame({
+                'Менеджер': top_managers.index,
+                'Средний коэффициент': top_managers.values.round(2)
+            })
+            if manager_ci is not None:
+                ci = manager_ci.set_index('manager').reindex(top_managers.index)
+                top_managers_df['Нижняя граница ДИ'] = ci['prolongation_rate_ci_low'].values.round(2)
+                top_managers_df['Верхняя граница ДИ'] = ci['prolongation_rate_ci_high'].values.round(2)
+            top_managers_df.to_excel(writer, sheet_name='Топ менеджеров', index=False)
+
+        # 6. Исходные данные
+        financial_long_data.head(1000).to_excel(writer, sheet_name='Исходные данные', index=False)
+
+        # 7. Прогноз пролонгированных отгрузок
+        if shipment_forecast is not None:
+            shipment_forecast.round(0).to_excel(writer, sheet_name='Прогноз отгрузок', index=False)
+
+        # 8. Качество данных
+        if data_quality is not None:
+            data_quality['summary'].to_excel(writer, sheet_name='Качество данных', index=False)
+            data_quality['issues'].to_excel(writer, sheet_name='Качество данных', index=False,
+                                            startcol=len(data_quality['summary'].columns) + 1)
+
+        # 9. Проекты под риском прекращения отгрузок
+        if projects_at_risk is not None:
+            projects_at_risk.round({'trend': 3, 'risk_score': 3, 'typical_amount': 0, 'amount_at_risk': 0}) \
+                .to_excel(writer, sheet_name='Проекты под риском', index=False)
+
+        # 10. Рейтинг менеджеров по суммам отгрузок
+        if manager_leaderboard is not None:
+            manager_leaderboard.round({'total_prev_shipment': 0, 'prolongated_shipment': 0,
+                                       'prolongation_rate': 2}) \
+                .to_excel(writer, sheet_name='Рейтинг менеджеров', index=False)
+
+    print("✅ Комплексный отчет сохранен в comprehensive_prolongation_report.xlsx")
+
+
+# ============================================================
+# ИНТЕРАКТИВНЫЙ ПРОСМОТР: куб коэффициентов месяц×менеджер×разрыв
+# ============================================================
+
+DEPARTMENT_LABEL = 'Весь отдел'
+CUBE_METRICS = ['base_projects', 'prolonged_projects', 'base_amount', 'prolonged_amount']
+
+
+def month_range(first_month, last_month):
+    """Непрерывный список календарных месяцев YYYY-MM от first_month до last_month"""
+    months = [first_month]
+    while months[-1] < last_month:
+        months.append(get_next_month(months[-1]))
+    return months
+
+
+def build_coefficient_cube(financial_long_data, prolongations_data, max_gap=3):
+    """
+    Предрасчет куба месяц×менеджер×разрыв×показатель
+    Разрыв g: отгрузка в месяце t-g-1, нет отгрузок в g промежуточных месяцах, отгрузка в t.
+    g=0 соответствует первому коэффициенту, g=1 - второму.
+    Первая строка по менеджерам - весь отдел (каждый проект учитывается один раз)
+    """
+    shipment_matrix, project_ids, data_months = build_shipment_matrix(financial_long_data)
+    months = month_range(data_months[0], data_months[-1])
+
+    # Календарная матрица: месяцы без данных - нулевые столбцы
+    amounts = np.zeros((len(project_ids), len(months)))
+    amounts[:, [months.index(month) for month in data_months]] = shipment_matrix
+    has_shipment = amounts > 0
+
+    managers, membership = _group_membership(build_manager_project_index(project_ids, prolongations_data),
+                                             len(project_ids))
+
+    values = np.zeros((len(months), len(managers), max_gap + 1, len(CUBE_METRICS)))
+    n_months = len(months)
+    for gap in range(max_gap + 1):
+        width = n_months - gap - 1
+        if width <= 0:
+            break
+        base = has_shipment[:, :width].copy()
+        for k in range(1, gap + 1):
+            base &= ~has_shipment[:, k:k + width]
+        returned = base & has_shipment[:, gap + 1:]
+
+        per_project = np.stack([
+            base,
+            returned,
+            np.where(base, amounts[:, :width], 0),
+            np.where(returned, amounts[:, gap + 1:], 0),
+        ], axis=-1).astype(float)  # проект × месяц × показатель
+        values[gap + 1:, :, gap, :] = np.einsum('gp,pmk->mgk', membership, per_project)
+
+    return {
+        'values': values,
+        'months': months,
+        'managers': managers,
+        'gaps': list(range(max_gap + 1)),
+        'metrics': list(CUBE_METRICS),
+    }
+
+
+def save_coefficient_cube(cube, path='coefficient_cube.npz'):
+    """Сохранение куба для повторного использования в ноутбуке"""
+    np.savez_compressed(path, values=cube['values'], months=np.array(cube['months']),
+                        managers=np.array(cube['managers']), gaps=np.array(cube['gaps']),
+                        metrics=np.array(cube['metrics']))
+
+
+def load_coefficient_cube(path='coefficient_cube.npz'):
+    """Загрузка ранее сохраненного куба"""
+    data = np.load(path)
+    return {
+        'values': data['values'],
+        'months': [str(month) for month in data['months']],
+        'managers': [str(manager) for manager in data['managers']],
+        'gaps': [int(gap) for gap in data['gaps']],
+        'metrics': [str(metric) for metric in data['metrics']],
+    }
+
+
+def slice_coefficient_cube(cube, first_month, last_month, manager=DEPARTMENT_LABEL, gap=0):
+    """Таблица показателей по месяцам для выбранного менеджера и разрыва (срез куба без пересчета)"""
+    start = cube['months'].index(first_month)
+    stop = cube['months'].index(last_month) + 1
+    block = cube['values'][start:stop, cube['managers'].index(manager), cube['gaps'].index(gap), :]
+
+    table = pd.DataFrame(block, columns=cube['metrics'])
+    table.insert(0, 'month', cube['months'][start:stop])
+    table['prolongation_rate'] = np.divide(table['prolonged_amount'], table['base_amount'],
+                                           out=np.zeros(len(table)), where=table['base_amount'] > 0)
+    table[['base_projects', 'prolonged_projects']] = table[['base_projects', 'prolonged_projects']].astype(int)
+    return table
+
+
+def create_prolongation_explorer(cube):
+    """
+    Виджет для ноутбука: диапазон месяцев, менеджер, показатель и длина разрыва
+    Все обновления - срезы предрасчитанного куба, анализ не перезапускается
+    """
+    if widgets is None:
+        raise RuntimeError("Для интерактивного просмотра требуется ipywidgets")
+
+    metric_options = {
+        'Коэффициент пролонгации': 'prolongation_rate',
+        'Пролонгировано проектов': 'prolonged_projects',
+        'Сумма пролонгации': 'prolonged_amount',
+    }
+
+    month_slider = widgets.SelectionRangeSlider(options=cube['months'],
+                                                index=(1, len(cube['months']) - 1),
+                                                description='Месяцы', layout=widgets.Layout(width='600px'))
+    manager_dropdown = widgets.Dropdown(options=cube['managers'], description='Менеджер')
+    metric_dropdown = widgets.Dropdown(options=metric_options, description='Показатель')
+    gap_slider = widgets.IntSlider(value=0, min=min(cube['gaps']), max=max(cube['gaps']),
+                                   description='Разрыв, мес.')
+    output = widgets.Output()
+
+    def update(_=None):
+        first_month, last_month = month_slider.value
+        table = slice_coefficient_cube(cube, first_month, last_month, manager_dropdown.value, gap_slider.value)
+        metric = metric_dropdown.value
+
+        with output:
+            output.clear_output(wait=True)
+            fig, ax = plt.subplots(figsize=(12, 4))
+            if metric == 'prolongation_rate':
+                ax.plot(table['month'], table[metric], marker='o', linewidth=2)
+                ax.set_ylim(0, max(1.1, table[metric].max() * 1.05))
+            else:
+                ax.bar(table['month'], table[metric], alpha=0.7)
+            ax.set_title(f"{manager_dropdown.label}: {metric_dropdown.label} (разрыв {gap_slider.value} мес.)",
+                         fontsize=12, fontweight='bold')
+            ax.tick_params(axis='x', rotation=45)
+            ax.grid(True, alpha=0.3)
+            plt.show()
+            display(table)
+
+    for control in (month_slider, manager_dropdown, metric_dropdown, gap_slider):
+        control.observe(update, names='value')
+    update()
+
+    return widgets.VBox([widgets.HBox([manager_dropdown, metric_dropdown, gap_slider]), month_slider, output])
+
+
+# ============================================================
+# СРАВНЕНИЕ ВЕРСИЙ ДАННЫХ (переиздание financial_data.csv)
+# ============================================================
+
+def _first_coefficient_for_months(shipment_matrix, months, target_months):
+    """Первый коэффициент только для указанных месяцев (предыдущий - соседний месяц в данных)"""
+    first = calculate_first_prolongation_coefficient_blocked(shipment_matrix, months).reindex(
+        columns=['month', 'projects_with_prev_shipment', 'prolongated_projects', 'total_prev_shipment',
+                 'prolongated_shipment', 'prolongation_rate'])
+    return first[first['month'].isin(target_months)].reset_index(drop=True)
+
+
+def diff_financial_snapshots(old_financial_long, new_financial_long, prolongations_data, rtol=1e-9):
+    """
+    Сравнение двух версий подготовленных данных
+    1. Ключевое векторное сравнение сумм по (id, month)
+    2. Пересчет только затронутых коэффициентов: первого (месяц изменения и следующий),
+       второго (месяц изменения и два следующих) и по менеджерам измененных проектов
+    Возвращает {'cells': измененные ячейки, 'coefficients': изменения коэффициентов}
+    """
+    print("\n" + "=" * 60)
+    print("🔀 СРАВНЕНИЕ ВЕРСИЙ ДАННЫХ")
+    print("=" * 60)
+
+    old_amounts = old_financial_long.groupby(['id', 'month'])['shipment_amount'].sum()
+    new_amounts = new_financial_long.groupby(['id', 'month'])['shipment_amount'].sum()
+    cells = pd.concat([old_amounts.rename('old_amount'), new_amounts.rename('new_amount')], axis=1).fillna(0.0)
+    changed = ~np.isclose(cells['old_amount'], cells['new_amount'], rtol=rtol, atol=0.005)
+    cells = cells[changed].reset_index()
+    cells['delta'] = cells['new_amount'] - cells['old_amount']
+
+    project_managers = prolongations_data[['id', 'AM']].drop_duplicates()
+    cells = cells.merge(project_managers, on='id', how='left')
+    cells['AM'] = cells['AM'].fillna('без А/М')
+    cells = cells.rename(columns={'AM': 'manager'}).sort_values(['month', 'id']).reset_index(drop=True)
+
+    print(f"   Изменено ячеек (id, month): {cells[['id', 'month']].drop_duplicates().shape[0]}, "
+          f"проектов: {cells['id'].nunique()}")
+
+    if len(cells) == 0:
+        return {'cells': cells, 'coefficients': pd.DataFrame(
+            columns=['coefficient', 'month', 'manager', 'old_value', 'new_value', 'delta'])}
+
+    old_matrix, old_ids, old_months = build_shipment_matrix(old_financial_long)
+    new_matrix, new_ids, new_months = build_shipment_matrix(new_financial_long)
+
+    changed_months = sorted(cells['month'].unique())
+    all_months = sorted(set(old_months) | set(new_months))
+    first_months = sorted({month for changed_month in changed_months
+                           for month in all_months[all_months.index(changed_month):all_months.index(changed_month) + 2]})
+    second_months = sorted({month for changed_month in changed_months
+                            for month in [changed_month, get_next_month(changed_month),
+                                          get_next_month(get_next_month(changed_month))]
+                            if month <= all_months[-1]})
+    manager_months = sorted({month for changed_month in changed_months
+                             for month in [changed_month, get_next_month(changed_month)]
+                             if month <= all_months[-1]})
+    affected_managers = set(cells['manager'])
+
+    delta_frames = []
+
+    def add_deltas(coefficient, old_values, new_values, keys, value_column, scale=1):
+        merged = old_values[keys + [value_column]].merge(new_values[keys + [value_column]], on=keys, how='outer',
+                                                         suffixes=('_old', '_new')).fillna(0)
+        merged = merged.rename(columns={f'{value_column}_old': 'old_value', f'{value_column}_new': 'new_value'})
+        merged[['old_value', 'new_value']] = merged[['old_value', 'new_value']] * scale
+        merged['delta'] = merged['new_value'] - merged['old_value']
+        merged['coefficient'] = coefficient
+        if 'manager' not in merged.columns:
+            merged['manager'] = DEPARTMENT_LABEL
+        delta_frames.append(merged[~np.isclose(merged['delta'], 0)])
+
+    add_deltas('Первый коэффициент',
+               _first_coefficient_for_months(old_matrix, old_months, first_months),
+               _first_coefficient_for_months(new_matrix, new_months, first_months),
+               ['month'], 'prolongation_rate')
+    add_deltas('Второй коэффициент',
+               pd.DataFrame(calculate_second_prolongation_coefficient_blocked(second_months, old_matrix, old_ids,
+                                                                              old_months)),
+               pd.DataFrame(calculate_second_prolongation_coefficient_blocked(second_months, new_matrix, new_ids,
+                                                                              new_months)),
+               ['month'], 'coefficient_second', scale=0.01)
+
+    old_manager_results = calculate_manager_prolongation_metrics_blocked(
+        old_matrix, old_ids, old_months, prolongations_data, manager_months, affected_managers)
+    new_manager_results = calculate_manager_prolongation_metrics_blocked(
+        new_matrix, new_ids, new_months, prolongations_data, manager_months, affected_managers)
+    empty_managers = pd.DataFrame(columns=['month', 'manager', 'prolongation_rate'])
+    add_deltas('Коэффициент менеджера',
+               old_manager_results if len(old_manager_results) > 0 else empty_managers,
+               new_manager_results if len(new_manager_results) > 0 else empty_managers,
+               ['month', 'manager'], 'prolongation_rate', scale=0.01)
+
+    coefficients = pd.concat(delta_frames, ignore_index=True)[
+        ['coefficient', 'month', 'manager', 'old_value', 'new_value', 'delta']
+    ].sort_values(['coefficient', 'month', 'manager']).reset_index(drop=True)
+
+    for _, row in coefficients.iterrows():
+        print(f"   {row['coefficient']} {row['month']} {row['manager']}: "
+              f"{row['old_value']:.2%} → {row['new_value']:.2%} ({row['delta']:+.2%})")
+
+    return {'cells': cells, 'coefficients': coefficients}
+
+
+def diff_financial_files(old_path, new_path, prolongations_path='prolongations.csv',
+                         output_path='prolongation_snapshot_diff.xlsx'):
+    """Сравнение двух выгрузок financial_data.csv с сохранением таблицы изменений"""
+    prolongations_data = pd.read_csv(prolongations_path)
+    diff = diff_financial_snapshots(prepare_financial_data(read_financial_csv(old_path)),
+                                    prepare_financial_data(read_financial_csv(new_path)),
+                                    prolongations_data)
+
+    with atomic_output(output_path) as temp_path, pd.ExcelWriter(temp_path, engine='openpyxl') as writer:
+        diff['coefficients'].to_excel(writer, sheet_name='Изменения коэффициентов', index=False)
+        diff['cells'].to_excel(writer, sheet_name='Измененные ячейки', index=False)
+
+    print(f"✅ Изменения сохранены в {output_path}")
+    return diff
+
+
+# ============================================================
+# ДОВЕРИТЕЛЬНЫЕ ИНТЕРВАЛЫ (бутстрэп по проектам)
+# ============================================================
+
+def _bootstrap_ratio(continued_amounts, base_amounts, rng, n_replicates, replicate_chunk=500):
+    """
+    Реплики коэффициента sum(continued) / sum(base) при повторной выборке проектов
+    Веса - мультиномиальная матрица (реплика × проект), генерируется блоками по replicate_chunk реплик,
+    чтобы память не росла с n_replicates × число проектов
+    """
+    n_projects = len(base_amounts)
+    probabilities = np.full(n_projects, 1 / n_projects)
+    replicates = np.empty(n_replicates)
+    for chunk_start in range(0, n_replicates, replicate_chunk):
+        chunk_size = min(replicate_chunk, n_replicates - chunk_start)
+        weights = rng.multinomial(n_projects, probabilities, size=chunk_size)
+        replicates[chunk_start:chunk_start + chunk_size] = (weights @ continued_amounts) / (weights @ base_amounts)
+    return replicates
+
+
+def bootstrap_first_coefficient_ci(financial_long_data, n_replicates=2000, confidence=0.95, seed=42,
+                                  replicate_chunk=500, session=None):
+    """
+    Доверительные интервалы первого коэффициента по месяцам
+    Возвращает month, prolongation_rate_ci_low, prolongation_rate_ci_high (в долях, как prolongation_rate)
+    session - готовая ProlongationSession: матрица отгрузок берется из нее
+    """
+    rng = np.random.default_rng(seed)
+    if session is None:
+        shipment_matrix, _, months = build_shipment_matrix(financial_long_data)
+    else:
+        shipment_matrix, months = session.shipment_matrix, session.months
+    tail = (1 - confidence) / 2 * 100
+
+    results_list = []
+    for i in range(1, len(months)):
+        prev_amounts = shipment_matrix[:, i - 1]
+        current_amounts = shipment_matrix[:, i]
+        base = prev_amounts > 0
+        if not base.any():
+            results_list.append({'month': months[i], 'prolongation_rate_ci_low': 0.0,
+                                 'prolongation_rate_ci_high': 0.0})
+            continue
+        continued_amounts = np.where(current_amounts[base] > 0, current_amounts[base], 0)
+        replicates = _bootstrap_ratio(continued_amounts, prev_amounts[base], rng, n_replicates, replicate_chunk)
+        ci_low, ci_high = np.percentile(replicates, [tail, 100 - tail])
+        results_list.append({'month': months[i], 'prolongation_rate_ci_low': ci_low,
+                             'prolongation_rate_ci_high': ci_high})
+
+    return pd.DataFrame(results_list)
+
+
+def bootstrap_manager_rate_ci(financial_long_data, prolongations_data, manager_results, n_replicates=2000,
+                              confidence=0.95, seed=42, replicate_chunk=500, session=None):
+    """
+    Доверительные интервалы среднего коэффициента менеджера (как в листе 'Топ менеджеров')
+    В каждой реплике проекты менеджера пересэмплируются независимо по месяцам,
+    коэффициенты месяцев усредняются. Значения в процентах, как prolongation_rate менеджера
+    """
+    rng = np.random.default_rng(seed)
+    if session is None:
+        session = ProlongationSession(financial_long_data, prolongations_data)
+    shipment_matrix, months, manager_rows = session.shipment_matrix, session.months, session.manager_rows
+    tail = (1 - confidence) / 2 * 100
+
+    results_list = []
+    for manager, manager_months in manager_results.groupby('manager')['month']:
+        rows = manager_rows.get(manager, np.array([], dtype=int))
+        monthly_replicates = []
+        for month in manager_months:
+            prev_amounts = _read_month_column(shipment_matrix, months, get_previous_month(month))[rows]
+            current_amounts = _read_month_column(shipment_matrix, months, month)[rows]
+            base = prev_amounts > 0
+            if not base.any():
+                continue
+            continued_amounts = np.where(current_amounts[base] > 0, current_amounts[base], 0)
+            monthly_replicates.append(_bootstrap_ratio(continued_amounts, prev_amounts[base], rng, n_replicates,
+                                                       replicate_chunk))
+
+        if not monthly_replicates:
+            continue
+        replicates = np.mean(monthly_replicates, axis=0) * 100
+        ci_low, ci_high = np.percentile(replicates, [tail, 100 - tail])
+        results_list.append({'manager': manager, 'prolongation_rate_ci_low': ci_low,
+                             'prolongation_rate_ci_high': ci_high})
+
+    return pd.DataFrame(results_list, columns=['manager', 'prolongation_rate_ci_low', 'prolongation_rate_ci_high'])
+
+
+# ============================================================
+# ПРОГНОЗ ПРОЛОНГИРОВАННЫХ ОТГРУЗОК (Монте-Карло)
+# ============================================================
+
+def estimate_project_transition_probabilities(shipment_matrix, prior_strength=5.0):
+    """
+    Вероятности продолжения и возврата для каждого проекта по истории матрицы отгрузок
+    Априорные значения - количественные первый и второй коэффициенты по отделу,
+    уточняются собственной историей проекта (бета-биномиальное сглаживание)
+    """
+    has_shipment = shipment_matrix > 0
+
+    # Продолжение: отгрузка в t-1 -> отгрузка в t (как в первом коэффициенте)
+    continuation_base = has_shipment[:, :-1]
+    continuation_hits = continuation_base & has_shipment[:, 1:]
+    # Возврат: отгрузка в t-2, пропуск t-1, отгрузка в t (как во втором коэффициенте)
+    return_base = has_shipment[:, :-2] & ~has_shipment[:, 1:-1]
+    return_hits = return_base & has_shipment[:, 2:]
+
+    prior_continuation = continuation_hits.sum() / max(continuation_base.sum(), 1)
+    prior_return = return_hits.sum() / max(return_base.sum(), 1)
+
+    p_continue = (continuation_hits.sum(axis=1) + prior_strength * prior_continuation) / \
+                 (continuation_base.sum(axis=1) + prior_strength)
+    p_return = (return_hits.sum(axis=1) + prior_strength * prior_return) / \
+               (return_base.sum(axis=1) + prior_strength)
+    return p_continue, p_return
+
+
+def simulate_prolonged_shipments(financial_long_data, prolongations_data, horizon_months=3, n_scenarios=10000,
+                                 seed=42, scenario_chunk=2000, percentiles=(5, 50, 95), session=None):
+    """
+    Распределение пролонгированных отгрузок на horizon_months вперед
+    Активные проекты (отгрузка в последнем месяце или пропуск одного месяца) на каждом шаге
+    продолжают отгрузки с вероятностью продолжения либо возвращаются после пропуска
+    с вероятностью возврата. Сумма отгрузки - средняя ненулевая сумма проекта за 3 последних месяца.
+    Сценарии считаются блоками по scenario_chunk одной операцией над массивом сценарий×проект
+    """
+    print("\n" + "=" * 60)
+    print("🎲 ПРОГНОЗ ПРОЛОНГИРОВАННЫХ ОТГРУЗОК (МОНТЕ-КАРЛО)")
+    print("=" * 60)
+
+    rng = np.random.default_rng(seed)
+    if session is None:
+        session = ProlongationSession(financial_long_data, prolongations_data)
+    shipment_matrix, project_ids, months = session.shipment_matrix, session.project_ids, session.months
+    manager_rows = session.manager_rows
+    p_continue, p_return = estimate_project_transition_probabilities(shipment_matrix)
+
+    # Состояние проектов на последний месяц данных
+    active = shipment_matrix[:, -1] > 0
+    lapsed = ~active & (shipment_matrix[:, -2] > 0) if len(months) > 1 else np.zeros_like(active)
+    in_scope = active | lapsed
+
+    typical_amount = _typical_shipment_amount(shipment_matrix)
+
+    groups, membership = _group_membership(manager_rows, len(project_ids))
+    membership = membership.T[in_scope]  # проект × группа
+
+    p_continue, p_return = p_continue[in_scope], p_return[in_scope]
+    typical_amount = typical_amount[in_scope]
+
+    # Состояния: 1 - отгрузка в прошлом месяце, 0 - пропуск одного месяца, -1 - выбыл
+    initial_state = np.where(active[in_scope], 1, 0).astype(np.int8)
+    totals = []
+    for chunk_start in range(0, n_scenarios, scenario_chunk):
+        chunk_size = min(scenario_chunk, n_scenarios - chunk_start)
+        state = np.broadcast_to(initial_state, (chunk_size, len(initial_state))).copy()
+        total = np.zeros(state.shape)
+        for _ in range(horizon_months):
+            draws = rng.random(state.shape)
+            shipped = np.where(state == 1, draws < p_continue, (state == 0) & (draws < p_return))
+            total += shipped * typical_amount
+            state = np.where(shipped, 1, np.where(state == 1, 0, -1)).astype(np.int8)
+        totals.append(total @ membership)
+    totals = np.vstack(totals)  # сценарий × группа
+
+    forecast_months = [get_next_month(months[-1])]
+    while len(forecast_months) < horizon_months:
+        forecast_months.append(get_next_month(forecast_months[-1]))
+
+    bands = np.percentile(totals, percentiles, axis=0)
+    forecast = pd.DataFrame({
+        'manager': groups,
+        'horizon': f"{forecast_months[0]} - {forecast_months[-1]}",
+        'active_projects': membership.sum(axis=0).astype(int),
+        'expected': totals.mean(axis=0),
+    })
+    for percentile, band in zip(percentiles, bands):
+        forecast[f'p{percentile}'] = band
+
+    for _, row in forecast.iterrows():
+        print(f"   {row['manager']}: ожидаемо {row['expected']:,.0f} руб. "
+              f"(P{percentiles[0]} {row[f'p{percentiles[0]}']:,.0f} - P{percentiles[-1]} {row[f'p{percentiles[-1]}']:,.0f})")
+
+    return forecast
+
+
+# ============================================================
+# РЕЙТИНГ МЕНЕДЖЕРОВ ПО СУММАМ (инкрементальный)
+# ============================================================
+
+class ManagerLeaderboard:
+    """
+    Рейтинг менеджеров по взвешенному коэффициенту: пролонгированные отгрузки / база за окно месяцев
+    Месяцы добавляются по одному (add_month); по каждому месяцу хранятся накопленные суммы,
+    поэтому итоги за любое окно - разность двух накопленных значений. Топ-N выбирается
+    ограниченной кучей (heapq.nlargest), число разных проектов считается только для попавших в топ
+    """
+
+    def __init__(self, project_ids, manager_rows):
+        self.project_ids = project_ids
+        self.managers = sorted(manager_rows)
+        self.manager_rows = {manager: manager_rows[manager] for manager in self.managers}
+        # Плоский индекс проект -> менеджер для сумм по всем менеджерам одним bincount
+        self._rows = np.concatenate([self.manager_rows[manager] for manager in self.managers]) \
+            if self.managers else np.array([], dtype=int)
+        self._groups = np.repeat(np.arange(len(self.managers)), [len(self.manager_rows[manager])
+                                                                  for manager in self.managers])
+        self.months = []
+        self._prev_amounts = None
+        self._base_flags = []
+        zeros = np.zeros(len(self.managers))
+        self._cumulative = {'total_prev_shipment': [zeros], 'prolongated_shipment': [zeros],
+                            'project_months': [zeros], 'prolongated_project_months': [zeros],
+                            'months': [zeros]}
+
+    @classmethod
+    def from_session(cls, session):
+        """Рейтинг по всей истории сессии анализа"""
+        leaderboard = cls(session.project_ids, session.manager_rows)
+        for month in session.months:
+            leaderboard.add_month(month, session.month_amounts(month))
+        return leaderboard
+
+    def add_month(self, month, amounts):
+        """
+        Добавление месяца: amounts - отгрузки всех проектов (в порядке project_ids)
+        База месяца - отгрузки предыдущего добавленного месяца, как в первом коэффициенте
+        """
+        amounts = np.asarray(amounts, dtype=np.float64)
+        if self._prev_amounts is None:
+            # Первый месяц служит только базой для следующего
+            self._prev_amounts = amounts
+            return
+
+        prev_amounts = self._prev_amounts[self._rows]
+        current_amounts = amounts[self._rows]
+        had_prev_shipment = prev_amounts > 0
+        continued = had_prev_shipment & (current_amounts > 0)
+
+        groups = len(self.managers)
+        month_totals = {
+            'total_prev_shipment': np.bincount(self._groups, weights=prev_amounts * had_prev_shipment,
+                                               minlength=groups),
+            'prolongated_shipment': np.bincount(self._groups, weights=current_amounts * continued,
+                                                minlength=groups),
+            'project_months': np.bincount(self._groups, weights=had_prev_shipment, minlength=groups),
+            'prolongated_project_months': np.bincount(self._groups, weights=continued, minlength=groups),
+        }
+        month_totals['months'] = (month_totals['project_months'] > 0).astype(float)
+        for key, values in month_totals.items():
+            self._cumulative[key].append(self._cumulative[key][-1] + values)
+
+        self.months.append(month)
+        self._base_flags.append(self._prev_amounts > 0)
+        self._prev_amounts = amounts
+
+    def _window_positions(self, first_month=None, last_month=None):
+        start = 0 if first_month is None else int(np.searchsorted(self.months, first_month))
+        end = len(self.months) if last_month is None else int(np.searchsorted(self.months, last_month, side='right'))
+        return start, max(start, end)
+
+    def _window_totals(self, start, end):
+        return {key: values[end] - values[start] for key, values in self._cumulative.items()}
+
+    def _distinct_projects(self, manager, start, end):
+        """Число разных проектов менеджера с базой в окне"""
+        if end <= start:
+            return 0
+        rows = self.manager_rows[manager]
+        return int(np.logical_or.reduce([flags[rows] for flags in self._base_flags[start:end]]).sum())
+
+    def _frame(self, managers, totals, start, end):
+        positions = [self.managers.index(manager) for manager in managers]
+        frame = pd.DataFrame({'manager': managers})
+        for key in ('months', 'project_months', 'prolongated_project_months',
+                    'total_prev_shipment', 'prolongated_shipment'):
+            frame[key] = totals[key][positions]
+        frame[['months', 'project_months', 'prolongated_project_months']] = \
+            frame[['months', 'project_months', 'prolongated_project_months']].astype(int)
+        frame.insert(2, 'projects', [self._distinct_projects(manager, start, end) for manager in managers])
+        frame['prolongation_rate'] = np.divide(frame['prolongated_shipment'] * 100, frame['total_prev_shipment'],
+                                               out=np.zeros(len(frame)),
+                                               where=frame['total_prev_shipment'].to_numpy() > 0)
+        frame['window'] = f"{self.months[start]} - {self.months[end - 1]}" if end > start else ''
+        return frame
+
+    def top(self, n=10, first_month=None, last_month=None, min_base=0.0, largest=True):
+        """
+        n лучших (largest=False - худших) менеджеров за окно [first_month, last_month]
+        min_base - минимальная база за окно, чтобы малые портфели не попадали в рейтинг случайно
+        """
+        start, end = self._window_positions(first_month, last_month)
+        totals = self._window_totals(start, end)
+        base = totals['total_prev_shipment']
+        rates = np.divide(totals['prolongated_shipment'], base, out=np.zeros(len(base)), where=base > 0)
+        candidates = ((rates[i], base[i], manager) for i, manager in enumerate(self.managers)
+                      if base[i] > 0 and base[i] >= min_base)
+        select = heapq.nlargest if largest else heapq.nsmallest
+        ranked = [manager for _, _, manager in select(n, candidates)]
+        leaderboard = self._frame(ranked, totals, start, end)
+        leaderboard.insert(0, 'rank', np.arange(1, len(leaderboard) + 1))
+        return leaderboard
+
+    def window(self, first_month=None, last_month=None):
+        """Итоги всех менеджеров за окно месяцев"""
+        start, end = self._window_positions(first_month, last_month)
+        return self._frame(self.managers, self._window_totals(start, end), start, end)
+
+
+def build_manager_leaderboard(financial_long_data, prolongations_data, top_n=10, window_months=12, session=None):
+    """
+    Рейтинг менеджеров для отчета: за всю историю и за последние window_months месяцев
+    """
+    print("\n" + "=" * 60)
+    print("🏅 РЕЙТИНГ МЕНЕДЖЕРОВ ПО СУММАМ ОТГРУЗОК")
+    print("=" * 60)
+
+    if session is None:
+        session = ProlongationSession(financial_long_data, prolongations_data)
+    leaderboard = session.leaderboard()
+
+    if not leaderboard.months:
+        return pd.DataFrame()
+
+    recent_first = leaderboard.months[max(0, len(leaderboard.months) - window_months)]
+    rankings = pd.concat([leaderboard.top(top_n), leaderboard.top(top_n, first_month=recent_first)],
+                         ignore_index=True)
+    for window, window_data in rankings.groupby('window', sort=False):
+        print(f"   Окно {window}:")
+        for _, row in window_data.head(3).iterrows():
+            print(f"   {row['rank']}. {row['manager']}: {row['prolongation_rate']:.1f}% "
+                  f"({row['projects']} проектов, {row['months']} мес.)")
+    return rankings
+
+
+# ============================================================
+# ПРОЕКТЫ ПОД РИСКОМ ПРЕКРАЩЕНИЯ ОТГРУЗОК
+# ============================================================
+
+def score_project_risk(shipment_matrix, project_ids, months, manager_rows, trend_window=6, prior_strength=5.0):
+    """
+    Признаки и риск прекращения отгрузок для всех проектов за один векторный проход по матрице
+    months_since_last_shipment - месяцев с последней отгрузки, streak_length - длина серии отгрузок
+    до последней отгрузки, trend - относительный наклон сумм за trend_window месяцев (доля в месяц),
+    gap_count - пропуски внутри истории, returns - возвраты после пропуска месяца (как во 2-м коэффициенте)
+    risk_score - вероятность, что в следующем месяце отгрузки не будет: 1 - p_continue для проектов
+    с отгрузкой в последнем месяце и 1 - p_return для пропустивших один месяц
+    Активные проекты - с отгрузкой в одном из двух последних месяцев; строка на проект и менеджера
+    """
+    shipment_matrix = np.asarray(shipment_matrix)
+    n_projects, n_months = shipment_matrix.shape
+    has_shipment = shipment_matrix > 0
+    month_positions = np.arange(n_months)
+
+    shipped_ever = has_shipment.any(axis=1)
+    last_position = n_months - 1 - np.argmax(has_shipment[:, ::-1], axis=1)
+    months_since_last = n_months - 1 - last_position
+
+    # Длина текущей серии: серия на каждый месяц считается по всем проектам сразу
+    run_length = np.zeros(n_projects, dtype=np.int32)
+    streak_length = np.zeros(n_projects, dtype=np.int32)
+    for position in range(n_months):
+        run_length = np.where(has_shipment[:, position], run_length + 1, 0)
+        streak_length = np.where(last_position == position, run_length, streak_length)
+
+    # Пропуски: переходы "отгрузка -> нет отгрузки" до последней отгрузки
+    gap_starts = has_shipment[:, :-1] & ~has_shipment[:, 1:]
+    gap_count = (gap_starts & (month_positions[1:] < last_position[:, None])).sum(axis=1)
+    returns = (has_shipment[:, :-2] & ~has_shipment[:, 1:-1] & has_shipment[:, 2:]).sum(axis=1)
+
+    # Тренд: наклон МНК по последним trend_window месяцам, нормированный на среднюю сумму
+    window = shipment_matrix[:, -trend_window:]
+    x = np.arange(window.shape[1]) - (window.shape[1] - 1) / 2
+    window_mean = window.mean(axis=1)
+    slope = (window - window_mean[:, None]) @ x / max((x ** 2).sum(), 1)
+    trend = np.divide(slope, window_mean, out=np.zeros(n_projects), where=window_mean > 0)
+
+    p_continue, p_return = estimate_project_transition_probabilities(shipment_matrix, prior_strength)
+    risk_score = np.where(months_since_last == 0, 1 - p_continue, 1 - p_return)
+
+    typical_amount = _typical_shipment_amount(shipment_matrix)
+
+    active = shipped_ever & (months_since_last <= 1)
+    scores = pd.DataFrame({
+        'row': np.flatnonzero(active),
+        'id': project_ids[active],
+        'last_shipment_month': np.asarray(months, dtype=object)[last_position[active]],
+        'months_since_last_shipment': months_since_last[active],
+        'streak_length': streak_length[active],
+        'trend': trend[active],
+        'gap_count': gap_count[active],
+        'returns': returns[active],
+        'typical_amount': typical_amount[active],
+        'risk_score': risk_score[active],
+    })
+    scores['amount_at_risk'] = scores['risk_score'] * scores['typical_amount']
+
+    scores = scores.merge(_manager_row_map(manager_rows), on='row', how='left').drop(columns=['row'])
+    scores['manager'] = scores['manager'].fillna('без А/М')
+
+    # При равном риске выше проекты с падающими отгрузками
+    return scores.sort_values(['risk_score', 'trend', 'amount_at_risk'], ascending=[False, True, False],
+                              kind='stable').reset_index(drop=True)
+
+
+def find_projects_at_risk(financial_long_data, prolongations_data, top_n=10, min_risk=0.5, session=None):
+    """
+    Список проектов под риском по менеджерам: до top_n проектов с risk_score >= min_risk
+    """
+    print("\n" + "=" * 60)
+    print("⚠️  ПРОЕКТЫ ПОД РИСКОМ ПРЕКРАЩЕНИЯ ОТГРУЗОК")
+    print("=" * 60)
+
+    if session is None:
+        session = ProlongationSession(financial_long_data, prolongations_data)
+    return session.projects_at_risk(top_n, min_risk)
+
+
+def _select_projects_at_risk(scores, top_n, min_risk):
+    at_risk = scores[scores['risk_score'] >= min_risk]
+    at_risk = at_risk.groupby('manager', sort=True).head(top_n).sort_values(
+        ['manager', 'risk_score', 'amount_at_risk'], ascending=[True, False, False]).reset_index(drop=True)
+
+    print(f"   Активных проектов: {scores['id'].nunique()}, под риском: {at_risk['id'].nunique()}")
+    for manager, manager_data in at_risk.groupby('manager'):
+        print(f"   👤 {manager}: {len(manager_data)} проект(ов), "
+              f"под угрозой {manager_data['amount_at_risk'].sum():,.0f} руб./мес.")
+
+    return at_risk
+
+
+# ============================================================
+# ОПОВЕЩЕНИЯ ОБ АНОМАЛИЯХ КОЭФФИЦИЕНТОВ
+# ============================================================
+
+COEFFICIENT_LABELS = {'first': '1-й коэффициент', 'second': '2-й коэффициент'}
+
+
+def build_coefficient_series(drilldown):
+    """
+    Помесячные ряды коэффициентов (%) по отделу и по менеджерам из детализации
+    Возвращает (rates, base): месяц × (coefficient, manager)
+    """
+    drilldown = drilldown.astype({'coefficient': str, 'month': str, 'manager': str})
+    department = drilldown.drop_duplicates(['coefficient', 'month', 'id']).assign(manager=DEPARTMENT_LABEL)
+    totals = pd.concat([department, drilldown], ignore_index=True) \
+        .groupby(['month', 'coefficient', 'manager'])[['base_amount', 'prolonged_amount']].sum()
+    base = totals['base_amount'].unstack(['coefficient', 'manager']).sort_index()
+    prolonged = totals['prolonged_amount'].unstack(['coefficient', 'manager']).sort_index()
+    rates = (prolonged * 100).div(base.where(base > 0))
+    return rates, base
+
+
+def detect_coefficient_anomalies(rates, base, window=6, min_periods=4, z_threshold=2.5, min_std=1.0,
+                                 min_base=0.0):
+    """
+    Необычные месяцы рядов коэффициентов: отклонение от скользящего среднего предыдущих
+    window месяцев больше z_threshold скользящих стандартных отклонений
+    Все ряды обрабатываются одним rolling по таблице; текущий месяц в свою базу не входит (shift).
+    min_std (п.п.) не дает стабильным рядам поднимать тревогу из-за долей процента
+    """
+    rolling = rates.rolling(window, min_periods=min_periods)
+    baseline = rolling.mean().shift(1)
+    spread = rolling.std().shift(1).clip(lower=min_std)
+    z_scores = (rates - baseline) / spread
+    flagged = (z_scores.abs() >= z_threshold) & (base >= min_base)
+
+    month_positions, series_positions = np.nonzero(flagged.to_numpy())
+    series = rates.columns[series_positions]
+    alerts = pd.DataFrame({
+        'month': rates.index[month_positions],
+        'coefficient': series.get_level_values('coefficient'),
+        'manager': series.get_level_values('manager'),
+        'value': rates.to_numpy()[month_positions, series_positions],
+        'rolling_mean': baseline.to_numpy()[month_positions, series_positions],
+        'rolling_std': spread.to_numpy()[month_positions, series_positions],
+        'z_score': z_scores.to_numpy()[month_positions, series_positions],
+        'base_amount': base.to_numpy()[month_positions, series_positions],
+    })
+    alerts['direction'] = np.where(alerts['z_score'] < 0, 'падение', 'рост')
+    return alerts.sort_values(['month', 'coefficient', 'manager']).reset_index(drop=True)
+
+
+def create_coefficient_alerts(financial_long_data, prolongations_data, output_path='prolongation_alerts.csv',
+                              recent_months=3, session=None, **detection_params):
+    """
+    Этап оповещений: ряды первого и второго коэффициентов по всей истории (отдел и менеджеры),
+    поиск аномалий и компактный CSV-файл; в консоль - аномалии последних recent_months месяцев
+    """
+    print("\n" + "=" * 60)
+    print("🚨 ОПОВЕЩЕНИЯ ОБ АНОМАЛИЯХ КОЭФФИЦИЕНТОВ")
+    print("=" * 60)
+
+    if session is None:
+        session = ProlongationSession(financial_long_data, prolongations_data)
+    rates, base = build_coefficient_series(session.drilldown(session.months[2:]))
+    alerts = detect_coefficient_anomalies(rates, base, **detection_params)
+
+    with atomic_output(output_path) as temp_path:
+        alerts.round({'value': 2, 'rolling_mean': 2, 'rolling_std': 2, 'z_score': 2, 'base_amount': 0}) \
+            .to_csv(temp_path, index=False, encoding='utf-8')
+
+    recent = alerts[alerts['month'].isin(rates.index[-recent_months:])]
+    print(f"   Рядов: {rates.shape[1]}, аномальных месяцев: {len(alerts)}, "
+          f"за последние {recent_months} мес.: {len(recent)}")
+    for _, row in recent.iterrows():
+        icon = '🔻' if row['direction'] == 'падение' else '🔺'
+        print(f"   {icon} {row['month']} {COEFFICIENT_LABELS[row['coefficient']]}, {row['manager']}: "
+              f"{row['value']:.1f}% при среднем {row['rolling_mean']:.1f}% (z = {row['z_score']:.1f})")
+    print(f"✅ Оповещения сохранены в {output_path}")
+    return alerts
+
+
+# ============================================================
+# HTML-ОТЧЕТ С КЭШИРОВАНИЕМ РАЗДЕЛОВ
+# ============================================================
+
+HTML_TEMPLATES = {
+    'page.html': """<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>Анализ пролонгации договоров</title>
+<style>
+body { font-family: Arial, sans-serif; margin: 24px; color: #222; }
+h1 { border-bottom: 2px solid #3b6fb6; padding-bottom: 8px; }
+section { margin-bottom: 32px; }
+table { border-collapse: collapse; font-size: 13px; }
+th, td { border: 1px solid #ccc; padding: 4px 8px; text-align: right; }
+th { background: #eef3fa; }
+td:first-child, th:first-child { text-align: left; }
+svg { display: block; margin: 8px 0; }
+</style>
+</head>
+<body>
+<h1>Анализ пролонгации договоров</h1>
+{% for section in sections %}{{ section }}
+{% endfor %}
+</body>
+</html>
+""",
+    'table.html': """<table>
+<tr>{% for column in table.columns %}<th>{{ column }}</th>{% endfor %}</tr>
+{% for row in table.itertuples(index=False) %}<tr>{% for value in row %}<td>{{ value }}</td>{% endfor %}</tr>
+{% endfor %}</table>""",
+    'summary.html': """<section id="summary">
+<h2>Сводка по отделу</h2>
+{% with table = summary %}{% include 'table.html' %}{% endwith %}
+</section>""",
+    'first.html': """<section id="first">
+<h2>Первый коэффициент пролонгации</h2>
+{{ chart }}
+{% with table = results %}{% include 'table.html' %}{% endwith %}
+</section>""",
+    'second.html': """<section id="second">
+<h2>Второй коэффициент пролонгации</h2>
+{{ chart }}
+{% with table = results %}{% include 'table.html' %}{% endwith %}
+</section>""",
+    'manager.html': """<section class="manager">
+<h3>{{ manager }}</h3>
+{{ chart }}
+{% with table = results %}{% include 'table.html' %}{% endwith %}
+</section>""",
+}
+
+
+def _svg_chart(labels, values, kind='line', width=640, height=160, color='#3b6fb6'):
+    """Легкий встроенный SVG-график (линия или столбцы) без matplotlib"""
+    values = [float(value) for value in values]
+    if not values:
+        return Markup('')
+    top = max(max(values), 1e-9)
+    step = width / len(values)
+    elements = []
+    for i, (label, value) in enumerate(zip(labels, values)):
+        x = step * (i + 0.5)
+        y = height - 20 - (height - 40) * value / top
+        if kind == 'bar':
+            elements.append(f'<rect x="{x - step * 0.35:.1f}" y="{y:.1f}" width="{step * 0.7:.1f}" '
+                            f'height="{height - 20 - y:.1f}" fill="{color}" opacity="0.7"/>')
+        else:
+            elements.append(f'<circle cx="{x:.1f}" cy="{y:.1f}" r="3" fill="{color}"/>')
+        elements.append(f'<text x="{x:.1f}" y="{height - 5}" font-size="9" text-anchor="middle">'
+                        f'{escape(str(label))}</text>')
+        elements.append(f'<text x="{x:.1f}" y="{y - 6:.1f}" font-size="9" text-anchor="middle">{value:.1f}</text>')
+    if kind == 'line':
+        points = ' '.join(f'{step * (i + 0.5):.1f},{height - 20 - (height - 40) * value / top:.1f}'
+                          for i, value in enumerate(values))
+        elements.insert(0, f'<polyline points="{points}" fill="none" stroke="{color}" stroke-width="2"/>')
+    return Markup(f'<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">'
+                  + ''.join(elements) + '</svg>')
+
+
+def build_department_summary(first_coeff_results, second_coeff_results, manager_results):
+    """Таблица 'Сводка по отделу' (общая для Excel и HTML-отчетов)"""
+    summary_data = {
+        'Показатель': [
+            'Средний коэффициент пролонгации (1-й)',
+            'Средний коэффициент пролонгации (2-й)',
+            'Всего пролонгировано проектов',
+            'Общий объем пролонгированных отгрузок',
+            'Период анализа',
+            'Количество менеджеров'
+        ],
+        'Значение': [
+            f"{first_coeff_results['prolongation_rate'].mean() * 100:.2f}%" if len(
+                first_coeff_results) > 0 else "0.00%",
+            f"{pd.DataFrame(second_coeff_results)['coefficient_second'].mean():.2f}%" if second_coeff_results else "0.00%",
+            f"{first_coeff_results['prolongated_projects'].sum()}" if len(first_coeff_results) > 0 else "0",
+            f"{first_coeff_results['prolongated_shipment'].sum():,.0f} руб." if len(
+                first_coeff_results) > 0 else "0 руб.",
+            f"{first_coeff_results['month'].min()} - {first_coeff_results['month'].max()}" if len(
+                first_coeff_results) > 0 else "Нет данных",
+            f"{manager_results['manager'].nunique()}" if len(manager_results) > 0 else "0"
+        ]
+    }
+    return pd.DataFrame(summary_data)
+
+
+def _fingerprint(*parts):
+    """Отпечаток входных данных раздела"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            part = part.to_json(orient='split', date_format='iso', double_precision=10)
+        digest.update(json.dumps(part, default=str, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()[:20]
+
+
+_HTML_ENVIRONMENTS = {}
+
+
+def _get_html_environment(cache_dir):
+    """Окружение Jinja2; скомпилированный байткод шаблонов хранится в cache_dir между запусками"""
+    if cache_dir not in _HTML_ENVIRONMENTS:
+        os.makedirs(cache_dir, exist_ok=True)
+        _HTML_ENVIRONMENTS[cache_dir] = jinja2.Environment(
+            loader=jinja2.DictLoader(HTML_TEMPLATES),
+            autoescape=True,
+            bytecode_cache=jinja2.FileSystemBytecodeCache(cache_dir),
+        )
+    return _HTML_ENVIRONMENTS[cache_dir]
+
+
+def _render_cached_section(environment, cache_dir, template_name, context_factory, *inputs):
+    """
+    Раздел берется из кэша, если его входные данные и шаблон не изменились
+    Возвращает фрагмент, признак попадания в кэш и путь к файлу фрагмента
+    """
+    key = _fingerprint(template_name, HTML_TEMPLATES[template_name], HTML_TEMPLATES['table.html'], *inputs)
+    cache_path = os.path.join(cache_dir, f'{template_name[:-5]}-{key}.html')
+    if os.path.exists(cache_path):
+        PIPELINE_METRICS.cache_hit('html_section')
+        with open(cache_path, encoding='utf-8') as cache_file:
+            return Markup(cache_file.read()), True, cache_path
+
+    fragment = environment.get_template(template_name).render(**context_factory())
+    with atomic_output(cache_path) as temp_path, open(temp_path, 'w', encoding='utf-8') as cache_file:
+        cache_file.write(fragment)
+    return Markup(fragment), False, cache_path
+
+
+def _prune_report_cache(cache_dir, used_paths):
+    """
+    Удаление фрагментов разделов, не использованных в последнем отчете (устаревшие данные,
+    выбывшие менеджеры). Байткод шаблонов Jinja2 (__jinja2_*.cache) не затрагивается
+    """
+    used = {os.path.abspath(path) for path in used_paths}
+    sections = {template_name[:-5] for template_name in HTML_TEMPLATES}
+    removed = 0
+    for file_name in os.listdir(cache_dir):
+        stem, extension = os.path.splitext(file_name)
+        if extension != '.html' or stem.rsplit('-', 1)[0] not in sections:
+            continue
+        path = os.path.join(cache_dir, file_name)
+        if os.path.abspath(path) not in used:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def create_html_report(first_coeff_results, second_coeff_results, manager_results,
+                       output_path='comprehensive_prolongation_report.html', cache_dir='.report_cache'):
+    """
+    HTML-отчет: сводка по отделу, оба коэффициента и разделы по менеджерам со встроенными графиками
+    Разделы кэшируются по отпечатку входных данных и перерисовываются только при их изменении
+    """
+    print("\n" + "=" * 60)
+    print("🌐 СОЗДАНИЕ HTML-ОТЧЕТА")
+    print("=" * 60)
+
+    if jinja2 is None:
+        print("⚠️  Jinja2 не установлен, HTML-отчет не создан")
+        return None
+
+    environment = _get_html_environment(cache_dir)
+    sections = []
+    fragment_paths = []
+    reused = 0
+
+    def add_section(template_name, context_factory, *inputs):
+        nonlocal reused
+        fragment, from_cache, fragment_path = _render_cached_section(environment, cache_dir, template_name,
+                                                                     context_factory, *inputs)
+        sections.append(fragment)
+        fragment_paths.append(fragment_path)
+        reused += from_cache
+
+    summary = build_department_summary(first_coeff_results, second_coeff_results, manager_results)
+    add_section('summary.html', lambda: {'summary': summary}, summary)
+
+    if len(first_coeff_results) > 0:
+        first_table = first_coeff_results[['month', 'projects_with_prev_shipment', 'prolongated_projects',
+                                           'total_prev_shipment', 'prolongated_shipment']].copy()
+        first_table['prolongation_rate_percent'] = (first_coeff_results['prolongation_rate'] * 100).round(2)
+        first_table[['total_prev_shipment', 'prolongated_shipment']] = \
+            first_table[['total_prev_shipment', 'prolongated_shipment']].round(0)
+        add_section('first.html', lambda: {
+            'results': first_table,
+            'chart': _svg_chart(first_table['month'], first_table['prolongation_rate_percent'])
+        }, first_table)
+
+    if second_coeff_results:
+        second_table = pd.DataFrame(second_coeff_results).drop(columns=['prolonged_projects'])
+        second_table['coefficient_second'] = second_table['coefficient_second'].round(2)
+        add_section('second.html', lambda: {
+            'results': second_table,
+            'chart': _svg_chart(second_table['month'], second_table['coefficient_second'], kind='bar',
+                                color='#e08a2c')
+        }, second_table)
+
+    for manager, manager_data in manager_results.groupby('manager') if len(manager_results) > 0 else []:
+        manager_table = manager_data.drop(columns=['manager']).sort_values('month').round(2)
+        add_section('manager.html', lambda: {
+            'manager': manager,
+            'results': manager_table,
+            'chart': _svg_chart(manager_table['month'], manager_table['prolongation_rate'])
+        }, manager, manager_table)
+
+    page = environment.get_template('page.html').render(sections=sections)
+    with atomic_output(output_path) as temp_path, open(temp_path, 'w', encoding='utf-8') as report_file:
+        report_file.write(page)
+    # Кэш хранит только разделы текущего отчета, иначе он растет с каждым изменением данных
+    removed = _prune_report_cache(cache_dir, fragment_paths)
+
+    print(f"✅ HTML-отчет сохранен в {output_path} (разделов из кэша: {reused} из {len(sections)}, "
+          f"удалено устаревших: {removed})")
+    return output_path
+
+
+# ============================================================
+# МЕТРИКИ PROMETHEUS
+# ============================================================
+
+class PipelineMetrics:
+    """
+    Метрики конвейера: длительность этапов и всего запуска, обработанные строки, попадания в кэш
+    и последние значения коэффициентов (в долях от 1). Без prometheus_client - no-op
+    """
+
+    def __init__(self):
+        self.enabled = CollectorRegistry is not None
+        self._recordings = []
+        if not self.enabled:
+            return
+
+        self.registry = CollectorRegistry()
+        self.stage_duration = Gauge('prolongation_stage_duration_seconds',
+                                    'Длительность этапа конвейера при последнем запуске',
+                                    ['stage'], registry=self.registry)
+        self.rows_processed = Counter('prolongation_rows_processed',
+                                      'Количество обработанных строк по этапам',
+                                      ['stage'], registry=self.registry)
+        self.cache_hits = Counter('prolongation_cache_hits',
+                                  'Попадания в кэш (этапы и разделы, пропущенные без пересчета)',
+                                  ['cache'], registry=self.registry)
+        self.first_coefficient = Gauge('prolongation_first_coefficient',
+                                       'Первый коэффициент пролонгации по месяцам',
+                                       ['month'], registry=self.registry)
+        self.second_coefficient = Gauge('prolongation_second_coefficient',
+                                        'Второй коэффициент пролонгации по месяцам',
+                                        ['month'], registry=self.registry)
+        self.manager_coefficient = Gauge('prolongation_manager_coefficient',
+                                         'Коэффициент пролонгации менеджера за последний месяц анализа '
+                                         '(нет серии - у менеджера нет базы в этом месяце)',
+                                         ['manager', 'month'], registry=self.registry)
+        self.run_duration = Gauge('prolongation_run_duration_seconds',
+                                  'Длительность последнего запуска анализа целиком (с учетом этапов из кэша)',
+                                  registry=self.registry)
+        self.last_success = Gauge('prolongation_last_success_timestamp_seconds',
+                                  'Время последнего успешного завершения анализа',
+                                  registry=self.registry)
+
+    def observe_stage(self, name, seconds):
+        """Длительность этапа: замеренная при выполнении или сохраненная в кэше этапа"""
+        if self.enabled:
+            self.stage_duration.labels(stage=name).set(seconds)
+
+    def observe_run(self, seconds):
+        if self.enabled:
+            self.run_duration.set(seconds)
+
+    def add_rows(self, stage, count):
+        self._record('rows_processed', stage, count)
+        if self.enabled:
+            self.rows_processed.labels(stage=stage).inc(count)
+
+    def cache_hit(self, cache):
+        self._record('cache_hits', cache, 1)
+        if self.enabled:
+            self.cache_hits.labels(cache=cache).inc()
+
+    def _record(self, counter, label, amount):
+        for counts in self._recordings:
+            counts[(counter, label)] = counts.get((counter, label), 0) + amount
+
+    @contextlib.contextmanager
+    def recording(self):
+        """
+        Приросты счетчиков внутри блока: {(счетчик, метка): прирост}
+        Нужны, чтобы перенести счетчики этапа из процесса-воркера в реестр основного процесса
+        """
+        counts = {}
+        self._recordings.append(counts)
+        try:
+            yield counts
+        finally:
+            self._recordings.remove(counts)
+
+    def merge_counts(self, counts):
+        """Прибавление приростов счетчиков, записанных в другом процессе"""
+        if not self.enabled:
+            return
+        for (counter, label), amount in counts.items():
+            getattr(self, counter).labels(label).inc(amount)
+
+    def publish_results(self, first_coeff_results, second_coeff_results, manager_results):
+        """
+        Публикация последних значений коэффициентов
+        Серии предыдущего запуска удаляются: выбывшие месяцы и менеджеры не должны экспортировать
+        устаревшие значения. Менеджеры - только за последний месяц анализа, без подстановки
+        их более ранних значений
+        """
+        if not self.enabled:
+            return
+
+        for gauge in (self.first_coefficient, self.second_coefficient, self.manager_coefficient):
+            gauge.clear()
+        for _, row in first_coeff_results.iterrows():
+            self.first_coefficient.labels(month=row['month']).set(row['prolongation_rate'])
+        for result in second_coeff_results:
+            self.second_coefficient.labels(month=result['month']).set(result['coefficient_second'] / 100)
+        if len(manager_results) > 0:
+            latest = manager_results[manager_results['month'] == manager_results['month'].max()]
+            for _, row in latest.iterrows():
+                self.manager_coefficient.labels(manager=row['manager'], month=row['month']).set(
+                    row['prolongation_rate'] / 100)
+        self.last_success.set_to_current_time()
+
+    def write_textfile(self, path):
+        """Запись метрик для textfile collector (node_exporter)"""
+        if not self.enabled:
+            print("⚠️  prometheus_client не установлен, метрики не записаны")
+            return
+        write_to_textfile(path, self.registry)
+        print(f"✅ Метрики сохранены в {path}")
+
+    def serve(self, port):
+        """HTTP-эндпоинт /metrics в текущем процессе"""
+        if not self.enabled:
+            raise RuntimeError("Для публикации метрик требуется prometheus_client")
+        start_http_server(port, registry=self.registry)
+        print(f"📡 Метрики доступны на http://0.0.0.0:{port}/metrics")
+
+
+PIPELINE_METRICS = PipelineMetrics()
+
+
+def serve_prolongation_metrics(port=8000, interval_seconds=3600, financial_source='financial_data.csv'):
+    """
+    Долгоживущий режим: HTTP-эндпоинт с метриками и перезапуск анализа каждые interval_seconds
+    """
+    PIPELINE_METRICS.serve(port)
+    while True:
+        try:
+            calculate_complete_prolongation_analysis(financial_source)
+        except Exception as e:
+            print(f"❌ Ошибка анализа: {e}")
+        time.sleep(interval_seconds)
+
+
+# ============================================================
+# ГРАФ ЭТАПОВ АНАЛИЗА С ПРОПУСКОМ НЕИЗМЕНИВШИХСЯ ЭТАПОВ
+# ============================================================
+
+PIPELINE_CACHE_DIR = '.pipeline_cache'
+
+
+def _files_fingerprint(paths):
+    """Отпечаток файлов по пути, размеру и времени изменения (как в make)"""
+    fingerprint = []
+    for path in paths:
+        stat = os.stat(path)
+        fingerprint.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return fingerprint
+
+
+def _run_stage_function(func, args):
+    """
+    Выполнение функции этапа (в текущем процессе или в процессе-воркере) с замером длительности
+    Кроме значения возвращает длительность и приросты счетчиков метрик за время этапа
+    """
+    started = time.perf_counter()
+    with PIPELINE_METRICS.recording() as counts:
+        value = func(*args)
+    return value, time.perf_counter() - started, counts
+
+
+def _charts_stage(bootstrapped, second_coeff_results_list):
+    create_visualizations(bootstrapped[0], second_coeff_results_list)
+
+
+def _manager_charts_stage(session):
+    # Для графиков менеджеров - динамика за всю историю, а не только за 6 месяцев
+    return create_manager_chart_pack(session.manager_metrics(session.months[1:]))
+
+
+def _report_stage(bootstrapped, second_coeff_results_list, manager_results_df, financial_long_prepared,
+                  shipment_forecast, projects_at_risk, manager_leaderboard, data_quality=None):
+    first_coeff_results, manager_ci = bootstrapped
+    create_comprehensive_report(first_coeff_results, second_coeff_results_list, manager_results_df,
+                                financial_long_prepared, data_quality, manager_ci, shipment_forecast,
+                                projects_at_risk, manager_leaderboard)
+
+
+def _drilldown_stage(session):
+    return export_prolongation_drilldown(session.drilldown())
+
+
+def _html_report_stage(bootstrapped, second_coeff_results_list, manager_results_df):
+    return create_html_report(bootstrapped[0], second_coeff_results_list, manager_results_df)
+
+
+class StageGraph:
+    """
+    Небольшой граф этапов анализа
+    Отпечаток этапа складывается из его параметров, входных файлов, версии кода и отпечатков зависимостей.
+    Результат этапа сохраняется в cache_dir и используется повторно, пока отпечаток не изменится
+    и на месте все выходные файлы этапа. Зависимости загружаются лениво - только если этап пересчитывается.
+    """
+
+    def __init__(self, cache_dir=PIPELINE_CACHE_DIR, force=False):
+        self.cache_dir = cache_dir
+        self.force = force
+        self.stages = {}
+        self.values = {}
+        self.fingerprints = {}
+        self.executed = []
+        self.skipped = []
+        self.code_fingerprint = _files_fingerprint([os.path.abspath(__file__)])
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def add(self, name, func, deps=(), params=None, input_files=(), output_files=()):
+        self.stages[name] = {
+            'func': func,
+            'deps': tuple(deps),
+            'params': params or {},
+            'input_files': tuple(input_files),
+            'output_files': tuple(output_files),
+        }
+
+    def fingerprint(self, name):
+        if name not in self.fingerprints:
+            stage = self.stages[name]
+            self.fingerprints[name] = _fingerprint(name, stage['params'], self.code_fingerprint,
+                                                   _files_fingerprint(stage['input_files']),
+                                                   [self.fingerprint(dep) for dep in stage['deps']])
+        return self.fingerprints[name]
+
+    def _cache_paths(self, name):
+        base = os.path.join(self.cache_dir, name)
+        return base + '.fingerprint', base + '.pkl'
+
+    def is_fresh(self, name):
+        """Этап можно пропустить: отпечаток совпадает и все выходные файлы на месте"""
+        if self.force:
+            return False
+        fingerprint_path, value_path = self._cache_paths(name)
+        if not os.path.exists(value_path) or not os.path.exists(fingerprint_path):
+            return False
+        if not all(os.path.exists(path) for path in self.stages[name]['output_files']):
+            return False
+        with open(fingerprint_path, encoding='utf-8') as fingerprint_file:
+            return fingerprint_file.read() == self.fingerprint(name)
+
+    def get(self, name):
+        """Результат этапа: из кэша или с пересчетом (и пересчетом устаревших зависимостей)"""
+        if name in self.values:
+            return self.values[name]
+
+        stage = self.stages[name]
+        fingerprint_path, value_path = self._cache_paths(name)
+        if self.is_fresh(name):
+            PIPELINE_METRICS.cache_hit('stage')
+            with open(value_path, 'rb') as value_file:
+                value, seconds = pickle.load(value_file)
+            # Длительность этапа из кэша - время его последнего фактического выполнения
+            PIPELINE_METRICS.observe_stage(name, seconds)
+            self.skipped.append(name)
+            self.values[name] = value
+        else:
+            args = [self.get(dep) for dep in stage['deps']]
+            # Счетчики этапа в текущем процессе уже учтены в реестре
+            value, seconds, _ = _run_stage_function(stage['func'], args)
+            PIPELINE_METRICS.observe_stage(name, seconds)
+            self._store(name, value, seconds)
+        return value
+
+    def _store(self, name, value, seconds):
+        fingerprint_path, value_path = self._cache_paths(name)
+        with atomic_output(value_path) as temp_path, open(temp_path, 'wb') as value_file:
+            pickle.dump((value, seconds), value_file, protocol=pickle.HIGHEST_PROTOCOL)
+        # Отпечаток пишется последним: прерванная запись оставляет этап устаревшим
+        with atomic_output(fingerprint_path) as temp_path, \
+                open(temp_path, 'w', encoding='utf-8') as fingerprint_file:
+            fingerprint_file.write(self.fingerprint(name))
+        self.executed.append(name)
+        self.values[name] = value
+
+    def run_concurrently(self, names, max_workers=None):
+        """
+        Независимые этапы (вывод графиков и отчетов) выполняются одновременно в отдельных процессах;
+        функции этих этапов должны быть определены на уровне модуля
+        """
+        stale = [name for name in names if name not in self.values and not self.is_fresh(name)]
+        if len(stale) < 2:
+            return self.run(names)
+
+        # Зависимости считаются в текущем процессе, воркерам передаются только готовые данные
+        inputs = {name: [self.get(dep) for dep in self.stages[name]['deps']] for name in stale}
+        with ProcessPoolExecutor(max_workers=min(len(stale), max_workers or os.cpu_count() or 1)) as executor:
+            futures = {name: executor.submit(_run_stage_function, self.stages[name]['func'], inputs[name])
+                       for name in stale}
+            for name in stale:
+                # Реестр метрик воркера теряется вместе с процессом - переносим его приросты
+                value, seconds, counts = futures[name].result()
+                PIPELINE_METRICS.observe_stage(name, seconds)
+                PIPELINE_METRICS.merge_counts(counts)
+                self._store(name, value, seconds)
+        return self.run(names)
+
+    def run(self, names):
+        """Выполнение этапов в заданном порядке"""
+        already_skipped = len(self.skipped)
+        for name in names:
+            self.get(name)
+        if self.skipped[already_skipped:]:
+            print(f"\n⏭️  Без изменений, взято из кэша: {', '.join(self.skipped[already_skipped:])}")
+        return self
+
+
+def calculate_complete_prolongation_analysis(financial_source='financial_data.csv', metrics_textfile=None,
+                                             validate=True, manager_charts=True, force=False,
+                                             cache_dir=PIPELINE_CACHE_DIR):
+    """
+    Полный анализ пролонгации с исправленной логикой
+    financial_source - файл, каталог или glob-шаблон региональных выгрузок
+    metrics_textfile - файл .prom для textfile collector Prometheus
+    validate - проверка качества исходных данных (для одного файла)
+    manager_charts - пакет графиков по менеджерам в каталоге manager_charts/
+    force - пересчитать все этапы, не используя кэш cache_dir
+    """
+    print("🚀 ЗАПУСК ИСПРАВЛЕННОГО АНАЛИЗА ПРОЛОНГАЦИЙ")
+    print("=" * 60)
+
+    started = time.perf_counter()
+    # Серия строк существует и при запуске целиком из кэша (тогда прирост 0)
+    PIPELINE_METRICS.add_rows('ingest', 0)
+    single_file = os.path.isfile(financial_source)
+    financial_files = resolve_financial_sources(financial_source)
+    graph = StageGraph(cache_dir, force=force)
+
+    # Загрузка данных; для набора выгрузок чтение и подготовка выполняются вместе в load_financial_exports
+    def ingest():
+        if single_file:
+            return read_financial_csv(financial_source, with_raw=True)
+        return None, None
+
+    def read_prolongations():
+        prolongations_data = pd.read_csv('prolongations.csv')
+        PIPELINE_METRICS.add_rows('ingest', len(prolongations_data))
+        return prolongations_data
+
+    def prepare(ingested):
+        financial_data, _ = ingested
+        if single_file:
+            financial_long_prepared = prepare_financial_data(financial_data)
+        else:
+            financial_long_prepared = load_financial_exports(financial_source)
+        PIPELINE_METRICS.add_rows('ingest', len(financial_long_prepared))
+        return financial_long_prepared
+
+    def second_coefficient(financial_long_prepared):
+        print("\n" + "=" * 60)
+        print("🔄 РАСЧЕТ ВТОРОГО КОЭФФИЦИЕНТА ПРОЛОНГАЦИИ (ИСПРАВЛЕННЫЙ)")
+        print("=" * 60)
+
+        second_coeff_results_list = []
+        analysis_months_2023 = [month for month in sorted(financial_long_prepared['month'].unique())
+                                if month.startswith('2023')]
+        for month in analysis_months_2023[:6]:  # Анализируем первые 6 месяцев 2023
+            try:
+                second_coeff_data = calculate_second_prolongation_coefficient_corrected(month, financial_long_prepared)
+                second_coeff_results_list.append(second_coeff_data)
+            except Exception as e:
+                print(f"❌ Ошибка при расчете второго коэффициента для {month}: {e}")
+        return second_coeff_results_list
+
+    # Доверительные интервалы (бутстрэп по проектам, фиксированный seed)
+    def bootstrap(session, first_coeff_results, manager_results_df):
+        first_coeff_results = first_coeff_results.merge(
+            bootstrap_first_coefficient_ci(session.financial_long_data, session=session), on='month', how='left')
+        manager_ci = bootstrap_manager_rate_ci(session.financial_long_data, session.prolongations_data,
+                                               manager_results_df, session=session)
+        return first_coeff_results, manager_ci
+
+    # Этапы по матрице отгрузок получают одну сессию вместо повторной сборки матрицы и индекса менеджеров
+    def session_stage(function):
+        return lambda session: function(session.financial_long_data, session.prolongations_data, session=session)
+
+    graph.add('ingest', ingest, params={'source': financial_source}, input_files=financial_files)
+    graph.add('prolongations', read_prolongations, input_files=['prolongations.csv'])
+    graph.add('prepare', prepare, deps=['ingest'])
+    graph.add('validate', lambda ingested, prolongations_data: validate_input_data(ingested[1], prolongations_data),
+              deps=['ingest', 'prolongations'])
+    graph.add('first_coefficient', calculate_first_prolongation_coefficient, deps=['prepare'])
+    graph.add('second_coefficient', second_coefficient, deps=['prepare'])
+    graph.add('managers', calculate_manager_prolongation_metrics, deps=['prepare', 'prolongations'])
+    graph.add('session', ProlongationSession, deps=['prepare', 'prolongations'])
+    graph.add('bootstrap', bootstrap, deps=['session', 'first_coefficient', 'managers'])
+    graph.add('forecast', session_stage(simulate_prolonged_shipments), deps=['session'])
+    graph.add('at_risk', session_stage(find_projects_at_risk), deps=['session'])
+    graph.add('leaderboard', session_stage(build_manager_leaderboard), deps=['session'])
+    graph.add('alerts', session_stage(create_coefficient_alerts), deps=['session'],
+              output_files=['prolongation_alerts.csv'])
+    graph.add('charts', _charts_stage, deps=['bootstrap', 'second_coefficient'],
+              output_files=['improved_prolongation_analysis.png'])
+    graph.add('manager_charts', _manager_charts_stage, deps=['session'],
+              output_files=[os.path.join('manager_charts', 'overview.png')])
+    validated = validate and single_file
+    graph.add('report', _report_stage,
+              deps=['bootstrap', 'second_coefficient', 'managers', 'prepare', 'forecast', 'at_risk',
+                    'leaderboard']
+                   + (['validate'] if validated else []),
+              output_files=['comprehensive_prolongation_report.xlsx'])
+    graph.add('html_report', _html_report_stage, deps=['bootstrap', 'second_coefficient', 'managers'],
+              output_files=['comprehensive_prolongation_report.html'])
+    graph.add('drilldown', _drilldown_stage, deps=['session'],
+              output_files=['prolongation_drilldown.parquet'])
+
+    graph.run((['validate'] if validated else [])
+              + ['first_coefficient', 'second_coefficient', 'managers', 'bootstrap', 'forecast', 'at_risk',
+                 'leaderboard', 'alerts'])
+    # Графики и отчеты не зависят друг от друга - строятся одновременно
+    # Без pyarrow этап детализации не объявляется: его выходной файл не появится и этап не станет актуальным
+    if pa_csv is None:
+        print("⚠️  pyarrow не установлен, детализация prolongation_drilldown.parquet не создается")
+    graph.run_concurrently(['charts'] + (['manager_charts'] if manager_charts else [])
+                           + ['report', 'html_report'] + (['drilldown'] if pa_csv is not None else []))
+
+    first_coeff_results = graph.get('bootstrap')[0]
+    second_coeff_results_list = graph.get('second_coefficient')
+    manager_results_df = graph.get('managers')
+
+    PIPELINE_METRICS.observe_run(time.perf_counter() - started)
+    PIPELINE_METRICS.publish_results(first_coeff_results, second_coeff_results_list, manager_results_df)
+    if metrics_textfile:
+        PIPELINE_METRICS.write_textfile(metrics_textfile)
+
+    # Сводная статистика
+    print("\n" + "=" * 60)
+    print("📈 СВОДНАЯ СТАТИСТИКА")
+    print("=" * 60)
+
+    if len(first_coeff_results) > 0:
+        avg_prolongation_rate = first_coeff_results['prolongation_rate'].mean()
+        total_prolongated_projects = first_coeff_results['prolongated_projects'].sum()
+        total_prolongated_shipment = first_coeff_results['prolongated_shipment'].sum()
+
+        print(f"📊 ОБЩИЕ РЕЗУЛЬТАТЫ:")
+        print(f"   • Средний коэффициент пролонгации (1-й): {avg_prolongation_rate:.2%}")
+        print(f"   • Всего пролонгировано проектов: {total_prolongated_projects}")
+        print(f"   • Общий объем пролонгированных отгрузок: {total_prolongated_shipment:,.0f} руб.")
+        print(
+            f"   • Анализированный период: {first_coeff_results['month'].min()} - {first_coeff_results['month'].max()}")
+
+        if second_coeff_results_list:
+            second_avg = pd.DataFrame(second_coeff_results_list)['coefficient_second'].mean()
+            print(f"   • Средний коэффициент пролонгации (2-й): {second_avg:.2f}%")
+
+        # Лучшие месяцы по пролонгации
+        best_months = first_coeff_results.nlargest(3, 'prolongation_rate')
+        print(f"\n🏆 ЛУЧШИЕ МЕСЯЦЫ ПО ПРОЛОНГАЦИИ:")
+        for _, row in best_months.iterrows():
+            print(f"   • {row['month']}: {row['prolongation_rate']:.2%} ({row['prolongated_projects']} проектов)")
+
+    return first_coeff_results, second_coeff_results_list, manager_results_df
+
+
+# ============================================================
+# ДИФФЕРЕНЦИАЛЬНАЯ ПРОВЕРКА БЫСТРЫХ РЕАЛИЗАЦИЙ
+# ============================================================
+
+RUSSIAN_MONTH_NAMES = {number: name.capitalize() for name, number in MONTH_MAPPING.items()}
+
+
+def generate_synthetic_financial_data(n_projects=300, n_months=16, start_month='2022-11', seed=0):
+    """
+    Синтетические данные в формате financial_data.csv и prolongations.csv
+    Включают пропуски месяцев, дубли с причинами, маркеры "стоп"/"в ноль"/"end",
+    проекты с несколькими менеджерами и без менеджера, а также назначения с пустым AM
+    и с явным 'без А/М'
+    """
+    rng = np.random.default_rng(seed)
+
+    months = [start_month]
+    while len(months) < n_months:
+        months.append(get_next_month(months[-1]))
+    headers = [f"{RUSSIAN_MONTH_NAMES[month[5:]]} {month[:4]}" for month in months]
+
+    # Отгрузки: проект активен с вероятностью, зависящей от активности в прошлом месяце
+    active = np.zeros((n_projects, n_months), dtype=bool)
+    active[:, 0] = rng.random(n_projects) < 0.5
+    for j in range(1, n_months):
+        active[:, j] = np.where(active[:, j - 1], rng.random(n_projects) < 0.85, rng.random(n_projects) < 0.15)
+    amounts = np.round(rng.lognormal(12, 1, size=(n_projects, n_months)), 2) * active
+
+    def format_amount(amount):
+        if amount == 0:
+            return rng.choice(['', 'стоп', 'в ноль', 'end'], p=[0.85, 0.05, 0.05, 0.05])
+        return f"{amount:,.2f}".replace(',', ' ').replace('.', ',')
+
+    managers = [f"Менеджер {i}" for i in range(1, 9)]
+    project_ids = rng.choice(np.arange(1, n_projects * 10), size=n_projects, replace=False)
+    records = []
+    for i, project_id in enumerate(project_ids):
+        row = {'id': project_id, 'Причина дубля': np.nan}
+        row.update({header: format_amount(amount) for header, amount in zip(headers, amounts[i])})
+        row['Account'] = managers[i % len(managers)]
+        records.append(row)
+        # Дубль проекта (например, частичная оплата) с меньшими суммами
+        if rng.random() < 0.1:
+            duplicate = dict(row, **{'Причина дубля': 'вторая часть оплаты'})
+            duplicate.update({header: format_amount(round(amount * 0.5, 2))
+                              for header, amount in zip(headers, amounts[i])})
+            records.append(duplicate)
+    financial_df = pd.DataFrame(records, columns=['id', 'Причина дубля'] + headers + ['Account'])
+
+    prolongation_records = []
+    for i, project_id in enumerate(project_ids):
+        if rng.random() < 0.1:
+            continue  # проект без менеджера
+        project_managers = list(rng.choice(managers, size=rng.integers(1, 3), replace=False))
+        assignment_kind = rng.random()
+        if assignment_kind < 0.05:
+            project_managers[-1] = np.nan  # пустая ячейка AM
+        elif assignment_kind < 0.1:
+            project_managers[-1] = 'без А/М'  # явное "без менеджера" в выгрузке
+        for manager in project_managers:
+            month = months[rng.integers(0, n_months)]
+            prolongation_records.append({
+                'id': project_id,
+                'month': f"{RUSSIAN_MONTH_NAMES[month[5:]].lower()} {month[:4]}",
+                'AM': manager
+            })
+    prolongations_df = pd.DataFrame(prolongation_records, columns=['id', 'month', 'AM'])
+
+    return financial_df, prolongations_df
+
+
+def _frames_match(reference, candidate, key_columns, rtol=1e-9):
+    """Сравнение таблиц результатов: счетчики совпадают точно, суммы и коэффициенты - с допуском"""
+    if len(reference) == 0 and len(candidate) == 0:
+        return True
+    if len(reference) != len(candidate):
+        return False
+    reference = reference.sort_values(key_columns).reset_index(drop=True)
+    candidate = candidate[reference.columns].sort_values(key_columns).reset_index(drop=True)
+    for column in reference.columns:
+        if column == 'prolonged_projects':
+            if [sorted(ids) for ids in reference[column]] != [sorted(ids) for ids in candidate[column]]:
+                return False
+        elif pd.api.types.is_float_dtype(reference[column]) or pd.api.types.is_float_dtype(candidate[column]):
+            if not np.allclose(reference[column].astype(float), candidate[column].astype(float), rtol=rtol):
+                return False
+        elif reference[column].tolist() != candidate[column].tolist():
+            return False
+    return True
+
+
+def _timed(function, *args):
+    """Вызов функции с замером времени и подавлением отладочного вывода"""
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def _matrix_engine(financial_csv_path, financial_long, prolongations_data, workdir):
+    session = ProlongationSession(financial_long, prolongations_data)
+    return {
+        'first': session.first_coefficient,
+        'second': session.second_coefficients,
+        'managers': session.manager_metrics,
+    }
+
+
+def _memmap_engine(financial_csv_path, financial_long, prolongations_data, workdir):
+    shipment_matrix, project_ids, months = build_shipment_memmap(financial_csv_path, os.path.join(workdir, 'store'))
+    return {
+        'first': lambda: calculate_first_prolongation_coefficient_blocked(shipment_matrix, months),
+        'second': lambda analysis_months: calculate_second_prolongation_coefficient_blocked(
+            analysis_months, shipment_matrix, project_ids, months),
+        'managers': lambda analysis_months: calculate_manager_prolongation_metrics_blocked(
+            shipment_matrix, project_ids, months, prolongations_data, analysis_months),
+    }
+
+
+def _sql_engine(financial_csv_path, financial_long, prolongations_data, workdir):
+    connection = open_prolongation_store(os.path.join(workdir, 'history.sqlite'))
+    load_into_prolongation_store(connection, financial_long, prolongations_data)
+    return {
+        'first': lambda: calculate_first_prolongation_coefficient_sql(connection),
+        'second': lambda analysis_months: [calculate_second_prolongation_coefficient_sql(month, connection)
+                                           for month in analysis_months],
+        'managers': lambda analysis_months: calculate_manager_prolongation_metrics_sql(connection, analysis_months),
+        'close': connection.close,
+    }
+
+
+# Быстрые реализации, сверяемые с эталонными (циклическими) функциями
+DIFFERENTIAL_ENGINES = {
+    'matrix': _matrix_engine,
+    'memmap': _memmap_engine,
+    'sql': _sql_engine,
+}
+
+# Результаты, сверяемые у каждой реализации, и ключи строк
+COEFFICIENT_RESULT_KEYS = [('first', ['month']), ('second', ['month']), ('managers', ['month', 'manager'])]
+
+
+def _reference_results(financial_long, prolongations_data, analysis_months):
+    """Эталонные результаты с замером времени: {'first', 'second', 'managers'} -> (результат, секунды)"""
+    return {
+        'first': _timed(calculate_first_prolongation_coefficient, financial_long),
+        'second': _timed(lambda: [calculate_second_prolongation_coefficient_corrected(month, financial_long)
+                                  for month in analysis_months]),
+        'managers': _timed(calculate_manager_prolongation_metrics, financial_long, prolongations_data),
+    }
+
+
+def _what_if_check(financial_csv_path, prolongations_csv_path, financial_df, prolongations_df, analysis_months,
+                   rtol):
+    """
+    Сценарии ProlongationSession.what_if против эталонных функций по исправленному CSV:
+    удалены строки с самой частой причиной дубля, суммы вне диапазона обнулены
+    """
+    session, setup_seconds = _timed(ProlongationSession.from_csv, financial_csv_path, prolongations_csv_path)
+
+    month_columns = [col for col in financial_df.columns if col not in FINANCIAL_ID_COLUMNS]
+    amounts = financial_df[month_columns].map(convert_to_float)
+    positive_amounts = amounts.to_numpy()[amounts.to_numpy() > 0]
+    min_amount, max_amount = (float(value) for value in np.percentile(positive_amounts, [25, 75]))
+    out_of_range = financial_df.copy()
+    out_of_range[month_columns] = amounts.where((amounts >= min_amount) & (amounts <= max_amount), 0.0)
+    scenarios = [('what_if_amount', {'min_amount': min_amount, 'max_amount': max_amount}, out_of_range)]
+    for reason in financial_df['Причина дубля'].value_counts().index[:1]:
+        scenarios.append(('what_if_reason', {'exclude_reasons': [reason]},
+                          financial_df[financial_df['Причина дубля'] != reason]))
+
+    rows = []
+    for function_name, filters, edited_df in scenarios:
+        edited_long, prepare_seconds = _timed(prepare_financial_data, edited_df)
+        reference = _reference_results(edited_long, prolongations_df, analysis_months)
+        candidate, candidate_seconds = _timed(lambda: session.what_if(analysis_months, **filters))
+        rows.append({
+            'engine': 'session',
+            'function': function_name,
+            'passed': all(_frames_match(pd.DataFrame(reference[name][0]), pd.DataFrame(candidate[name]),
+                                        key_columns, rtol)
+                          for name, key_columns in COEFFICIENT_RESULT_KEYS),
+            'reference_seconds': prepare_seconds + sum(seconds for _, seconds in reference.values()),
+            'engine_seconds': candidate_seconds,
+            'setup_seconds': setup_seconds,
+        })
+    return rows
+
+
+def _arrow_csv_check(financial_csv_path, prolongations_csv_path, financial_df, prolongations_df, analysis_months,
+                     rtol):
+    """
+    read_financial_csv (разбор сумм при чтении средствами Arrow) против pd.read_csv + convert_to_float:
+    строки melt_financial_data совпадают по порядку и значениям
+    """
+    if pa_csv is None:
+        return []
+    reference, reference_seconds = _timed(lambda: melt_financial_data(pd.read_csv(financial_csv_path)))
+    candidate, candidate_seconds = _timed(lambda: melt_financial_data(read_financial_csv(financial_csv_path)))
+
+    def as_list(column):
+        # Пропуски из Arrow (None) и из pandas (NaN) считаются одинаковыми
+        return column.astype(object).where(column.notna(), None).tolist()
+
+    passed = (len(reference) == len(candidate)
+              and np.allclose(reference['shipment_amount'], candidate['shipment_amount'], rtol=rtol)
+              and all(as_list(reference[column]) == as_list(candidate[column])
+                      for column in ['id', 'Причина дубля', 'Account', 'month']))
+    return [{
+        'engine': 'arrow',
+        'function': 'read_csv',
+        'passed': passed,
+        'reference_seconds': reference_seconds,
+        'engine_seconds': candidate_seconds,
+        'setup_seconds': 0.0,
+    }]
+
+
+def _drilldown_check(financial_csv_path, prolongations_csv_path, financial_df, prolongations_df, analysis_months,
+                     rtol):
+    """
+    Детализация prolongation_drilldown.parquet против эталонных функций (листов отчета):
+    число проектов, база и продленные отгрузки по месяцам и по менеджерам совпадают
+    """
+    financial_long = prepare_financial_data(financial_df)
+    session, setup_seconds = _timed(ProlongationSession, financial_long, prolongations_df)
+    drilldown, candidate_seconds = _timed(session.drilldown, analysis_months)
+    reference = _reference_results(financial_long, prolongations_df, analysis_months)
+
+    first_columns = ['projects_with_prev_shipment', 'prolongated_projects', 'total_prev_shipment',
+                     'prolongated_shipment']
+    department = drilldown.drop_duplicates(['coefficient', 'month', 'id'])
+    comparisons = [
+        ('first', department[department['coefficient'] == 'first'], first_columns),
+        ('second', department[department['coefficient'] == 'second'],
+         ['projects_count', 'prolonged_count_second', 'total_completion_amount', 'total_second_prolongation_amount']),
+        ('managers', drilldown[(drilldown['coefficient'] == 'first') & drilldown['month'].isin(analysis_months)],
+         first_columns),
+    ]
+    passed = True
+    for (name, key_columns), (_, rows, columns) in zip(COEFFICIENT_RESULT_KEYS, comparisons):
+        reference_result = pd.DataFrame(reference[name][0])
+        totals = rows.groupby(key_columns).agg(projects=('id', 'size'), prolonged=('prolonged', 'sum'),
+                                               base_amount=('base_amount', 'sum'),
+                                               prolonged_amount=('prolonged_amount', 'sum'))
+        totals.columns = columns
+        if len(reference_result) == 0:
+            passed &= len(totals) == 0
+            continue
+        # Месяцы эталона без базы в детализации отсутствуют - для них нули
+        keys = reference_result.set_index(key_columns).index
+        candidate = totals.reindex(keys, fill_value=0).reset_index()
+        passed &= (len(totals.index.difference(keys)) == 0
+                   and _frames_match(reference_result[key_columns + columns], candidate, key_columns, rtol))
+
+    return [{
+        'engine': 'session',
+        'function': 'drilldown',
+        'passed': bool(passed),
+        'reference_seconds': sum(seconds for _, seconds in reference.values()),
+        'engine_seconds': candidate_seconds,
+        'setup_seconds': setup_seconds,
+    }]
+
+
+# Сверки сценариев и вспомогательных реализаций, не сводящихся к трем коэффициентам
+DIFFERENTIAL_CHECKS = {
+    'what_if': _what_if_check,
+    'arrow_csv': _arrow_csv_check,
+    'drilldown': _drilldown_check,
+}
+
+
+def run_differential_check(synthetic_datasets=3, synthetic_projects=300, seed=0, rtol=1e-9, engines=None,
+                           checks=None):
+    """
+    Сверка быстрых реализаций с эталонными функциями
+    Эталон - calculate_first_prolongation_coefficient, calculate_second_prolongation_coefficient_corrected
+    и calculate_manager_prolongation_metrics. Проверка выполняется на исходных CSV и на
+    synthetic_datasets случайных наборах; для каждой функции фиксируется ускорение
+    checks - дополнительные сверки (DIFFERENTIAL_CHECKS), например сценарии what_if против исправленного CSV
+    """
+    print("\n" + "=" * 60)
+    print("🧪 ДИФФЕРЕНЦИАЛЬНАЯ ПРОВЕРКА РАСЧЕТОВ")
+    print("=" * 60)
+
+    datasets = []
+    if os.path.exists('financial_data.csv') and os.path.exists('prolongations.csv'):
+        datasets.append(('csv', pd.read_csv('financial_data.csv'), pd.read_csv('prolongations.csv')))
+    for i in range(synthetic_datasets):
+        financial_df, prolongations_df = generate_synthetic_financial_data(n_projects=synthetic_projects,
+                                                                          seed=seed + i)
+        datasets.append((f'synthetic_{seed + i}', financial_df, prolongations_df))
+
+    report_rows = []
+    for dataset_name, financial_df, prolongations_df in datasets:
+        financial_long = prepare_financial_data(financial_df)
+        analysis_months = [month for month in sorted(financial_long['month'].unique())
+                           if month.startswith('2023')][:6]
+
+        reference = _reference_results(financial_long, prolongations_df, analysis_months)
+
+        for engine_name, engine_factory in (engines or DIFFERENTIAL_ENGINES).items():
+            with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as workdir:
+                financial_csv_path = os.path.join(workdir, 'financial_data.csv')
+                financial_df.to_csv(financial_csv_path, index=False)
+                engine, setup_seconds = _timed(engine_factory, financial_csv_path, financial_long,
+                                               prolongations_df, workdir)
+
+                candidates = {
+                    'first': _timed(engine['first']),
+                    'second': _timed(engine['second'], analysis_months),
+                    'managers': _timed(engine['managers'], analysis_months),
+                }
+                if 'close' in engine:
+                    engine['close']()
+
+            for function_name, key_columns in COEFFICIENT_RESULT_KEYS:
+                reference_result, reference_seconds = reference[function_name]
+                candidate_result, candidate_seconds = candidates[function_name]
+                passed = _frames_match(pd.DataFrame(reference_result), pd.DataFrame(candidate_result),
+                                       key_columns, rtol)
+                report_rows.append({
+                    'dataset': dataset_name,
+                    'engine': engine_name,
+                    'function': function_name,
+                    'passed': passed,
+                    'reference_seconds': reference_seconds,
+                    'engine_seconds': candidate_seconds,
+                    'setup_seconds': setup_seconds,
+                })
+
+        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as workdir:
+            financial_csv_path = os.path.join(workdir, 'financial_data.csv')
+            prolongations_csv_path = os.path.join(workdir, 'prolongations.csv')
+            financial_df.to_csv(financial_csv_path, index=False)
+            prolongations_df.to_csv(prolongations_csv_path, index=False)
+            for check in (checks if checks is not None else DIFFERENTIAL_CHECKS).values():
+                for row in check(financial_csv_path, prolongations_csv_path, financial_df, prolongations_df,
+                                 analysis_months, rtol):
+                    report_rows.append(dict(row, dataset=dataset_name))
+
+    report = pd.DataFrame(report_rows)
+    report['speedup'] = report['reference_seconds'] / report['engine_seconds'].where(report['engine_seconds'] > 0)
+    for _, row in report.iterrows():
+        status = '✅' if row['passed'] else '❌'
+        print(f"   {status} {row['dataset']:<14} {row['engine']:<8} {row['function']:<15} "
+              f"ускорение ×{row['speedup']:.1f}")
+
+    failed = (~report['passed']).sum()
+    print(f"\n   Проверок: {len(report)}, расхождений: {failed}")
+    return report
+
+
+def print_main_results(first_coeff_results, second_coeff_results, manager_results):
+    """Краткие итоги запуска из командной строки"""
+    print("\n📊 ОСНОВНЫЕ РЕЗУЛЬТАТЫ:")
+    print(f"  • Проанализировано месяцев: {len(first_coeff_results)}")
+    print(f"  • Рассчитано вторых коэффициентов: {len(second_coeff_results)}")
+    print(f"  • Проанализировано менеджеров: "
+          f"{manager_results['manager'].nunique() if len(manager_results) > 0 else 0}")
+
+
+# ЗАПУСК ПРОГРАММЫ
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Анализ пролонгации договоров')
+    parser.add_argument('--check', action='store_true',
+                        help='сверить быстрые реализации с эталонными функциями')
+    parser.add_argument('--source', default='financial_data.csv',
+                        help='файл, каталог или glob-шаблон финансовых выгрузок')
+    parser.add_argument('--metrics-textfile', help='записать метрики Prometheus в файл .prom')
+    parser.add_argument('--serve-metrics', type=int, metavar='PORT',
+                        help='долгоживущий режим: отдавать метрики по HTTP и перезапускать анализ')
+    parser.add_argument('--interval', type=int, default=3600, help='период перезапуска анализа, секунд')
+    parser.add_argument('--diff', nargs=2, metavar=('OLD_CSV', 'NEW_CSV'),
+                        help='сравнить две версии financial_data.csv')
+    parser.add_argument('--force', action='store_true', help='пересчитать все этапы, не используя кэш')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='расчет по дисковой матрице отгрузок (для истории, не помещающейся в память)')
+    parser.add_argument('--storage-dir', default='shipment_store',
+                        help='каталог дисковой матрицы для --out-of-core')
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help='дописать выгрузки --source в SQLite-хранилище и посчитать коэффициенты SQL-запросами')
+    args = parser.parse_args()
+
+    if args.diff:
+        diff_financial_files(*args.diff)
+        sys.exit(0)
+
+    if args.check:
+        check_report = run_differential_check()
+        sys.exit(0 if check_report['passed'].all() else 1)
+
+    if args.serve_metrics:
+        serve_prolongation_metrics(args.serve_metrics, args.interval, args.source)
+
+    if args.out_of_core:
+        if not os.path.isfile(args.source):
+            parser.error('--out-of-core работает с одним файлом выгрузки (--source)')
+        first_coeff, second_coeff, manager_results = calculate_out_of_core_prolongation_analysis(
+            args.source, storage_dir=args.storage_dir)
+        print_main_results(first_coeff, second_coeff, manager_results)
+        sys.exit(0)
+
+    if args.sqlite:
+        if os.path.isfile(args.source):
+            financial_long = prepare_financial_data(read_financial_csv(args.source))
+        else:
+            financial_long = load_financial_exports(args.source)
+        first_coeff, second_coeff, manager_results = calculate_prolongation_analysis_sql(
+            args.sqlite, financial_long, pd.read_csv('prolongations.csv'))
+        print_main_results(first_coeff, second_coeff, manager_results)
+        sys.exit(0)
+
+    first_coeff, second_coeff, manager_results = calculate_complete_prolongation_analysis(
+        args.source, metrics_textfile=args.metrics_textfile, force=args.force)
+
+    print("\n🎉 ПОЛНЫЙ АНАЛИЗ ЗАВЕРШЕН!")
+    print("=" * 60)
+    print("Созданные файлы:")
+    print("  1. improved_prolongation_analysis.png - Графики анализа")
+    print("  2. comprehensive_prolongation_report.xlsx - Полный отчет")
+    print_main_results(first_coeff, second_coeff, manager_results)
 
     if second_coeff:
         print(f"  • Второй коэффициент показывает проекты, которые 'вернулись' после пропуска месяца")